@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Suq1 -- An ad hoc Python toolbox for a web service
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2009, 2010, 2011, 2012 Easter-eggs & Emmanuel Raviart
+# Copyright (C) 2013, 2014 Easter-eggs, Etalab & Emmanuel Raviart
+# https://github.com/eraviart/suq1
+#
+# This file is part of Suq1.
+#
+# Suq1 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Suq1 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark the dispatch of requests by urls.make_router, according to the number of routes"""
+
+
+import argparse
+import re
+import sys
+import timeit
+
+import webob
+
+from suq1 import urls
+
+
+def make_linear_router(*routings):
+    """Return a router that tries every route in turn (the algorithm used before routes were indexed)."""
+    routes = []
+    for routing in routings:
+        methods, regex, app = routing[:3]
+        if isinstance(methods, basestring):
+            methods = (methods,)
+        routes.append((methods, re.compile(unicode(regex)), app))
+
+    def router(environ, start_response):
+        req = webob.Request(environ)
+        for methods, regex, app in routes:
+            if methods is None or req.method in methods:
+                match = regex.match(req.path_info)
+                if match is not None:
+                    req.urlvars = match.groupdict()
+                    req.script_name += req.path_info[:match.end()]
+                    req.path_info = req.path_info[match.end():]
+                    return app(req.environ, start_response)
+        return None
+
+    return router
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--number', default = 10000, help = 'number of dispatches per measure', type = int)
+    args = parser.parse_args()
+
+    def app(environ, start_response):
+        return environ
+
+    for routes_count in (10, 100, 500):
+        routings = [
+            (('GET', 'POST'), r'^/api/1/resources{}/(?P<id>[^/]+)/?$'.format(index), app)
+            for index in range(routes_count)
+            ]
+        # To measure requests matching no route without measuring the building of 404 responses, the no-match case
+        # adds a catch-all route (like a "not found" controller) after the routes.
+        catch_all_routings = routings + [(None, r'^', app)]
+        for case, path, case_routings in (
+                ('last route', '/api/1/resources{}/123'.format(routes_count - 1), routings),
+                ('no route', '/api/1/unknown/123', catch_all_routings),
+                ):
+            for name, router in (
+                    ('linear', make_linear_router(*case_routings)),
+                    ('indexed', urls.make_router(*case_routings)),
+                    ):
+                environ = webob.Request.blank(path).environ
+
+                def dispatch():
+                    return router(environ.copy(), None)
+
+                duration = min(timeit.repeat(dispatch, number = args.number, repeat = 3))
+                print '{} routes, {} router: {:.2f} µs per dispatch to {}'.format(routes_count, name,
+                    duration * 1000000 / args.number, case)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
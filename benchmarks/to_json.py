@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Suq1 -- An ad hoc Python toolbox for a web service
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2009, 2010, 2011, 2012 Easter-eggs & Emmanuel Raviart
+# Copyright (C) 2013, 2014 Easter-eggs, Etalab & Emmanuel Raviart
+# https://github.com/eraviart/suq1
+#
+# This file is part of Suq1.
+#
+# Suq1 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Suq1 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark the conversion of accesses & clients to JSON, with and without converters compiled once per class"""
+
+
+import argparse
+import datetime
+import sys
+import timeit
+import uuid
+
+from bson import objectid
+
+from suq1 import accesses, contexts, conv, objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--number', default = 10000, help = 'number of conversions per measure', type = int)
+    args = parser.parse_args()
+
+    components = dict(
+        contexts = contexts,
+        conv = conv,
+        db = None,
+        model = accesses,
+        )
+    accesses.init_module(components)
+    objects.init_module(components)
+
+    now = datetime.datetime.utcnow()
+    client = accesses.Client(
+        _id = objectid.ObjectId(),
+        draft_id = objectid.ObjectId(),
+        name = u'Benchmark Client',
+        owner_id = objectid.ObjectId(),
+        published = now,
+        symbol = u'benchmark',
+        updated = now,
+        url_name = u'benchmark-client',
+        )
+    access = accesses.Access(
+        _id = objectid.ObjectId(),
+        account_id = objectid.ObjectId(),
+        client_id = client._id,
+        draft_id = objectid.ObjectId(),
+        expiration = now + datetime.timedelta(hours = 4),
+        published = now,
+        token = unicode(uuid.uuid4()),
+        updated = now,
+        )
+
+    for instance in (access, client):
+        cls = instance.__class__
+
+        def to_json_uncached():
+            # Reset the class caches, to measure the cost of building the converters at each call.
+            cls._attributes_serializer = None
+            cls._attributes_to_json = None
+            return instance.to_json()
+
+        uncached_duration = min(timeit.repeat(to_json_uncached, number = args.number, repeat = 3))
+        cached_duration = min(timeit.repeat(instance.to_json, number = args.number, repeat = 3))
+        print '{}.to_json: {:.2f} µs per call when built at each call, {:.2f} µs per call when compiled once'.format(
+            cls.__name__, uncached_duration * 1000000 / args.number, cached_duration * 1000000 / args.number)
+
+        instances = [instance] * args.number
+        batch_duration = min(timeit.repeat(lambda: cls.instances_to_json(instances), number = 1, repeat = 3))
+        print '{}.instances_to_json: {:.2f} µs per instance'.format(
+            cls.__name__, batch_duration * 1000000 / args.number)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
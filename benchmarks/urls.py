@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Suq1 -- An ad hoc Python toolbox for a web service
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2009, 2010, 2011, 2012 Easter-eggs & Emmanuel Raviart
+# Copyright (C) 2013, 2014 Easter-eggs, Etalab & Emmanuel Raviart
+# https://github.com/eraviart/suq1
+#
+# This file is part of Suq1.
+#
+# Suq1 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Suq1 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark the quoting of URL paths, with and without the cache of urls.quote_fragment()"""
+
+
+import argparse
+import sys
+import timeit
+import urllib
+import uuid
+
+from suq1 import urls
+
+
+def quote_path_uncached(path):
+    # The quoting used before quote_fragment() had a cache.
+    return u'/'.join(
+        urllib.quote(sub_fragment.encode('utf-8'), safe = ',/:').decode('utf-8')
+        for fragment in path
+        if fragment
+        for sub_fragment in unicode(fragment).split(u'/')
+        if sub_fragment
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--number', default = 10000, help = 'number of quotings per measure', type = int)
+    args = parser.parse_args()
+
+    # Static fragments are always found in cache, while IDs are a new fragment at each call.
+    static_path = (u'api', u'1', u'accounts', u'édition')
+    ids = [unicode(uuid.uuid4()) for index in range(args.number)]
+
+    for case, uncached_function, cached_function in (
+            (
+                'static path',
+                lambda: quote_path_uncached(static_path),
+                lambda: urls.quote_path(static_path),
+                ),
+            (
+                'path with an ID',
+                lambda: quote_path_uncached((u'api', u'1', u'accounts', ids.pop(), u'édition')),
+                lambda: urls.quote_path((u'api', u'1', u'accounts', ids.pop(), u'édition')),
+                ),
+            ):
+        for name, function in (('urllib.quote', uncached_function), ('quote_fragment', cached_function)):
+            durations = []
+            for repeat in range(3):
+                ids[:] = [unicode(uuid.uuid4()) for index in range(args.number)]
+                durations.append(timeit.timeit(function, number = args.number))
+            print '{}, {}: {:.2f} µs per path'.format(case, name, min(durations) * 1000000 / args.number)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# Suq1 -- An ad hoc Python toolbox for a web service
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2009, 2010, 2011, 2012 Easter-eggs & Emmanuel Raviart
+# Copyright (C) 2013, 2014 Easter-eggs, Etalab & Emmanuel Raviart
+# https://github.com/eraviart/suq1
+#
+# This file is part of Suq1.
+#
+# Suq1 is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Suq1 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark the validation of request parameters, with validators built at each request or compiled once"""
+
+
+import argparse
+import collections
+import sys
+import timeit
+import uuid
+
+from suq1 import conv
+
+
+def make_params_validator():
+    # Same schema as new_authentication_session_params_validator & upsert_client_params_validator (without the
+    # conversion of access tokens, that needs a database).
+    return conv.struct(
+        dict(
+            access_token = conv.noop,
+            blocked = conv.pipe(
+                conv.test_isinstance((bool, int)),
+                conv.anything_to_bool,
+                conv.default(False),
+                ),
+            context = conv.test_isinstance(basestring),  # For asynchronous calls
+            name = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.cleanup_line,
+                conv.not_none,
+                ),
+            synchronizer_token = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.input_to_uuid_str,
+                conv.not_none,
+                ),
+            ),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-n', '--number', default = 10000, help = 'number of validations per measure', type = int)
+    args = parser.parse_args()
+
+    inputs = collections.OrderedDict(sorted(dict(
+        access_token = unicode(uuid.uuid4()),
+        blocked = True,
+        context = u'benchmark',
+        name = u'  Benchmark Client ',
+        synchronizer_token = unicode(uuid.uuid4()),
+        ).iteritems()))
+    compiled_validator = make_params_validator()
+
+    def construct():
+        return make_params_validator()
+
+    def execute():
+        return compiled_validator(inputs, state = conv.default_state)
+
+    def construct_and_execute():
+        return make_params_validator()(inputs, state = conv.default_state)
+
+    for name, function in (
+            ('construction', construct),
+            ('execution of compiled validator', execute),
+            ('construction & execution', construct_and_execute),
+            ):
+        duration = min(timeit.repeat(function, number = args.number, repeat = 3))
+        print '{}: {:.2f} µs per call'.format(name, duration * 1000000 / args.number)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
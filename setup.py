@@ -63,6 +63,9 @@ setup(
     data_files = [
         ('share/locale/fr/LC_MESSAGES', ['suq1/i18n/fr/LC_MESSAGES/suq1.mo']),
         ],
+    extras_require = dict(
+        msgpack = ['msgpack-python >= 0.5.2'],
+        ),
     install_requires = [
         'Babel >= 0.9.4',
         'Biryani1 >= 0.9dev',
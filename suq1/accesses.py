@@ -27,9 +27,11 @@
 """Models for access, account & client classes"""
 
 
-import calendar
 import collections
+import copy
 import datetime
+import threading
+import time
 import uuid
 
 from biryani1 import strings
@@ -40,6 +42,8 @@ from . import objects
 
 __all__ = [
     'Access',
+    'access_cache',
+    'AccessCache',
     'Account',
     'AuthenticationSession',
     'Client',
@@ -50,6 +54,105 @@ conv = None  # from ??? import conv
 model = None  # from ??? import model
 
 
+class AccessCache(object):
+    """Bounded per-process cache of validated accesses (with their account & client), indexed by token
+
+    The cache stores BSON documents, not instances: each hit builds new instances, so that a request can't modify the
+    accesses, accounts & clients used by other requests.
+
+    An access is evicted from cache when its time-to-live has elapsed, when it has expired, when the cache is full
+    (oldest accesses first) or when the access, its account or its client is saved or deleted.
+    """
+    hits = 0
+    misses = 0
+
+    def __init__(self, max_size = 10000, ttl = 60):
+        # token => (deadline, IDs, (class, BSON) of access, (class, BSON) of account, (class, BSON) of client),
+        # oldest first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.tokens_by_id = {}  # ID of access, account or client => set of tokens
+        self.ttl = ttl  # in seconds
+
+    def add(self, access):
+        if self.max_size <= 0:
+            return
+        # Account & client are cached with access, so load them now.
+        account = access.account
+        client = access.client
+        token = access.token
+        ids = (access._id, access.account_id, access.client_id)
+        now = time.time()
+        entry = (
+            now + self.ttl,
+            ids,
+            (access.__class__, copy.deepcopy(access.to_bson())),
+            (account.__class__, copy.deepcopy(account.to_bson())) if account is not None else None,
+            (client.__class__, copy.deepcopy(client.to_bson())) if client is not None else None,
+            )
+        with self.lock:
+            self.discard_entry(token)
+            self.entries[token] = entry
+            for id in ids:
+                if id is not None:
+                    self.tokens_by_id.setdefault(id, set()).add(token)
+            # Since every entry has the same time-to-live, the oldest entries are the first to be outdated.
+            while self.entries:
+                oldest_token = next(iter(self.entries))
+                if len(self.entries) <= self.max_size and self.entries[oldest_token][0] >= now:
+                    break
+                self.discard_entry(oldest_token)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens_by_id.clear()
+
+    def discard_entry(self, token):
+        # Lock must be held by caller.
+        entry = self.entries.pop(token, None)
+        if entry is None:
+            return
+        for id in entry[1]:
+            tokens = self.tokens_by_id.get(id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self.tokens_by_id[id]
+
+    def get(self, token):
+        """Return a new instance of the cached access with given token (with its account & client), or None."""
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None and entry[0] < time.time():
+                self.discard_entry(token)
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        deadline, ids, access_item, account_item, client_item = entry
+        access = instantiate_cached_bson(access_item)
+        if access.expired:
+            with self.lock:
+                if self.entries.get(token) is entry:
+                    self.discard_entry(token)
+            self.misses += 1
+            return None
+        access._account = instantiate_cached_bson(account_item)
+        access._client = instantiate_cached_bson(client_item)
+        self.hits += 1
+        return access
+
+    def invalidate(self, id):
+        """Evict every access using given access, account or client ID."""
+        if id is None:
+            return
+        with self.lock:
+            for token in list(self.tokens_by_id.get(id, ())):
+                self.discard_entry(token)
+
+
 class Access(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, objects.ActivityStreamWrapper):
     _account = UnboundLocalError
     _client = UnboundLocalError
@@ -58,6 +161,7 @@ class Access(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
     client_id = None
     collection_name = 'access'
     expiration = None
+    identity_keys = ('token',)
     token = None
 
     @property
@@ -68,6 +172,14 @@ class Access(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
                 else None
         return self._account
 
+    def after_delete(self, ctx, old_bson, *args, **kwargs):
+        super(Access, self).after_delete(ctx, old_bson, *args, **kwargs)
+        access_cache.invalidate(self._id)
+
+    def after_upsert(self, ctx, old_bson, bson, *args, **kwargs):
+        super(Access, self).after_upsert(ctx, old_bson, bson, *args, **kwargs)
+        access_cache.invalidate(self._id)
+
     @property
     def client(self):
         if self._client is UnboundLocalError:
@@ -80,9 +192,35 @@ class Access(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
     def ensure_indexes(cls):
         cls.ensure_index('account_id')
         cls.ensure_index('client_id')
-        cls.ensure_index('expiration')
+        # Let MongoDB remove expired accesses.
+        cls.ensure_index('expiration', expireAfterSeconds = 0)
         cls.ensure_index('token', unique = True)
 
+    @property
+    def expired(self):
+        return self.expiration is not None and self.expiration <= datetime.datetime.utcnow()
+
+    @classmethod
+    def get_attributes_json_type(cls):
+        return dict(
+            _account = 'hidden',
+            _client = 'hidden',
+            _id = 'id',
+            account_id = 'object_id',
+            client_id = 'object_id',
+            draft_id = 'object_id',
+            expiration = 'datetime',
+            published = 'datetime',
+            updated = 'datetime',
+            )
+
+    @classmethod
+    def get_relations(cls):
+        return dict(
+            account = ('account_id', model.Account),
+            client = ('client_id', model.Client),
+            )
+
     @property
     def individual(self):
         return self.account or self.client
@@ -97,17 +235,18 @@ class Access(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
             if state is None:
                 state = conv.default_state
 
-            # First, delete expired instances.
-            cls.remove_expired(state)
-
-            self = cls.find_one(
-                dict(
-                    token = value,
-                    ),
-                as_class = collections.OrderedDict,
-                )
+            self = access_cache.get(value)
             if self is None:
-                return value, state._(u"No access with given token")
+                self = cls.find_one(
+                    dict(
+                        token = value,
+                        ),
+                    as_class = collections.OrderedDict,
+                    )
+                # Expired accesses are removed by MongoDB, but not immediately.
+                if self is None or self.expired:
+                    return value, state._(u"No access with given token")
+                access_cache.add(self)
             if self.blocked:
                 return self, state._(u"Access is blocked")
 
@@ -129,11 +268,7 @@ class Access(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
 
     @classmethod
     def remove_expired(cls, ctx):
-        for self in cls.find(
-                dict(expiration = {'$lt': datetime.datetime.utcnow()}),
-                as_class = collections.OrderedDict,
-                ):
-            self.delete(ctx)
+        cls.delete_many(ctx, dict(expiration = {'$lt': datetime.datetime.utcnow()}))
 
     def to_bson(self):
         self_bson = self.__dict__.copy()
@@ -141,29 +276,6 @@ class Access(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
         self_bson.pop('_client', None)
         return self_bson
 
-    def turn_to_json_attributes(self, state):
-        value, error = conv.object_to_clean_dict(self, state = state)
-        if error is not None:
-            return value, error
-        value.pop('_account', None)
-        value.pop('_client', None)
-        if value.get('account_id') is not None:
-            value['account_id'] = unicode(value['account_id'])
-        if value.get('client_id') is not None:
-            value['client_id'] = unicode(value['client_id'])
-        if value.get('draft_id') is not None:
-            value['draft_id'] = unicode(value['draft_id'])
-        if value.get('expiration') is not None:
-            value['expiration'] = int(calendar.timegm(value['expiration'].timetuple()) * 1000)
-        id = value.pop('_id', None)
-        if id is not None:
-            value['id'] = unicode(id)
-        if value.get('published') is not None:
-            value['published'] = int(calendar.timegm(value['published'].timetuple()) * 1000)
-        if value.get('updated') is not None:
-            value['updated'] = int(calendar.timegm(value['updated'].timetuple()) * 1000)
-        return value, None
-
 
 class Account(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, objects.ActivityStreamWrapper):
     blocked = False
@@ -171,11 +283,23 @@ class Account(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obj
     email = None
     email_verified = None  # Datetime of last email verification
     full_name = None
+    identity_keys = ('email',)
     url_name = None
 
-    def before_delete(self, ctx, old_bson):
-        for access in model.Access.find(dict(account_id = self._id), as_class = collections.OrderedDict):
-            access.delete(ctx)
+    def after_delete(self, ctx, old_bson, *args, **kwargs):
+        super(Account, self).after_delete(ctx, old_bson, *args, **kwargs)
+        access_cache.invalidate(self._id)
+
+    def after_upsert(self, ctx, old_bson, bson, *args, **kwargs):
+        super(Account, self).after_upsert(ctx, old_bson, bson, *args, **kwargs)
+        access_cache.invalidate(self._id)
+
+    def before_delete(self, ctx, old_bson, *args, **kwargs):
+        model.Access.delete_many(ctx, dict(account_id = self._id))
+
+    @classmethod
+    def before_delete_many(cls, ctx, old_bsons, *args, **kwargs):
+        model.Access.delete_many(ctx, dict(account_id = {'$in': [old_bson['_id'] for old_bson in old_bsons]}))
 
     def compute_attributes(self):
         url_name = conv.check(conv.input_to_url_name)(self.full_name)
@@ -204,6 +328,17 @@ class Account(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obj
         cls.ensure_index('url_name', sparse = True)
         cls.ensure_index('words')
 
+    @classmethod
+    def get_attributes_json_type(cls):
+        return dict(
+            _id = 'id',
+            draft_id = 'object_id',
+            email_verified = 'datetime',
+            published = 'datetime',
+            updated = 'datetime',
+            words = 'hidden',
+            )
+
     def get_valid_permanent_access(self, client = None):
         return model.Access.find_one(
             dict(
@@ -235,30 +370,13 @@ class Account(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obj
                 return email, state._(u"No account with given email")
         return self, None
 
-    def turn_to_json_attributes(self, state):
-        value, error = conv.object_to_clean_dict(self, state = state)
-        if error is not None:
-            return value, error
-        if value.get('draft_id') is not None:
-            value['draft_id'] = unicode(value['draft_id'])
-        if value.get('email_verified') is not None:
-            value['email_verified'] = int(calendar.timegm(value['email_verified'].timetuple()) * 1000)
-        id = value.pop('_id', None)
-        if id is not None:
-            value['id'] = unicode(id)
-        if value.get('published') is not None:
-            value['published'] = int(calendar.timegm(value['published'].timetuple()) * 1000)
-        if value.get('updated') is not None:
-            value['updated'] = int(calendar.timegm(value['updated'].timetuple()) * 1000)
-        value.pop('words', None)
-        return value, None
-
 
 class AuthenticationSession(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, objects.SmartWrapper):
     _client = UnboundLocalError
     client_id = None
     collection_name = 'authentication_sessions'
     expiration = None
+    identity_keys = ('token',)
     synchronizer_token = None  # the UI session anti CSRF token
     token = None  # the cookie token
 
@@ -272,16 +390,23 @@ class AuthenticationSession(objects.Initable, objects.JsonMonoClassMapper, objec
 
     @classmethod
     def ensure_indexes(cls):
-        cls.ensure_index('expiration')
+        # Let MongoDB remove expired authentication sessions.
+        cls.ensure_index('expiration', expireAfterSeconds = 0)
         cls.ensure_index('token', unique = True)
 
+    @property
+    def expired(self):
+        return self.expiration is not None and self.expiration <= datetime.datetime.utcnow()
+
+    @classmethod
+    def get_relations(cls):
+        return dict(
+            client = ('client_id', model.Client),
+            )
+
     @classmethod
     def remove_expired(cls, ctx):
-        for self in cls.find(
-                dict(expiration = {'$lt': datetime.datetime.utcnow()}),
-                as_class = collections.OrderedDict,
-                ):
-            self.delete(ctx)
+        cls.delete_many(ctx, dict(expiration = {'$lt': datetime.datetime.utcnow()}))
 
     def to_bson(self):
         self_bson = self.__dict__.copy()
@@ -295,11 +420,9 @@ class AuthenticationSession(objects.Initable, objects.JsonMonoClassMapper, objec
         if state is None:
             state = conv.default_state
 
-        # First, delete expired instances.
-        cls.remove_expired(state)
-
         self = cls.find_one(dict(token = value), as_class = collections.OrderedDict)
-        if self is None:
+        # Expired sessions are removed by MongoDB, but not immediately.
+        if self is None or self.expired:
             return value, state._(u"No session with UUID {0}").format(value)
         return self, None
 
@@ -307,14 +430,26 @@ class AuthenticationSession(objects.Initable, objects.JsonMonoClassMapper, objec
 class Client(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, objects.ActivityStreamWrapper):
     blocked = False
     collection_name = 'clients'
+    identity_keys = ('symbol',)
     name = None
     owner_id = None
     symbol = None
     url_name = None
 
-    def before_delete(self, ctx, old_bson):
-        for access in Access.find(dict(client_id = self._id), as_class = collections.OrderedDict):
-            access.delete(ctx)
+    def after_delete(self, ctx, old_bson, *args, **kwargs):
+        super(Client, self).after_delete(ctx, old_bson, *args, **kwargs)
+        access_cache.invalidate(self._id)
+
+    def after_upsert(self, ctx, old_bson, bson, *args, **kwargs):
+        super(Client, self).after_upsert(ctx, old_bson, bson, *args, **kwargs)
+        access_cache.invalidate(self._id)
+
+    def before_delete(self, ctx, old_bson, *args, **kwargs):
+        model.Access.delete_many(ctx, dict(client_id = self._id))
+
+    @classmethod
+    def before_delete_many(cls, ctx, old_bsons, *args, **kwargs):
+        model.Access.delete_many(ctx, dict(client_id = {'$in': [old_bson['_id'] for old_bson in old_bsons]}))
 
     def compute_attributes(self):
         url_name = conv.check(conv.input_to_url_name)(self.name)
@@ -335,6 +470,17 @@ class Client(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
 
         return self
 
+    @classmethod
+    def get_attributes_json_type(cls):
+        return dict(
+            _id = 'id',
+            draft_id = 'object_id',
+            owner_id = 'object_id',
+            published = 'datetime',
+            updated = 'datetime',
+            words = 'hidden',
+            )
+
     def get_valid_permanent_access(self, client = None):
         # Note:  client parameter is not used, but is kept for compatibility with method
         # Account.get_valid_permanent_access.
@@ -368,23 +514,6 @@ class Client(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
             return id, state._(u"No client with given ID")
         return self, None
 
-    def turn_to_json_attributes(self, state):
-        value, error = conv.object_to_clean_dict(self, state = state)
-        if error is not None:
-            return value, error
-        if value.get('draft_id') is not None:
-            value['draft_id'] = unicode(value['draft_id'])
-        id = value.pop('_id', None)
-        if id is not None:
-            value['id'] = unicode(id)
-        value['owner_id'] = unicode(value['owner_id'])
-        if value.get('published') is not None:
-            value['published'] = int(calendar.timegm(value['published'].timetuple()) * 1000)
-        if value.get('updated') is not None:
-            value['updated'] = int(calendar.timegm(value['updated'].timetuple()) * 1000)
-        value.pop('words', None)
-        return value, None
-
     @classmethod
     def upsert_with_access(cls, ctx, name, symbol):
         self = cls.find_one(dict(symbol = symbol), as_class = collections.OrderedDict)
@@ -414,9 +543,23 @@ class Client(objects.Initable, objects.JsonMonoClassMapper, objects.Mapper, obje
         return access
 
 
+access_cache = AccessCache()
+
+
 def init_module(components):
     global conv
     conv = components['conv']
     global model
     model = components['model']
 
+
+def instantiate_cached_bson(item):
+    """Build a new instance from a couple (class, BSON) stored in AccessCache, or return None."""
+    if item is None:
+        return None
+    cls, bson = item
+    self = cls.from_bson(copy.deepcopy(bson))
+    if isinstance(self, objects.Wrapper):
+        # When the current request has already loaded the same document, use it.
+        self = cls.remember(self)
+    return self
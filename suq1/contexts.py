@@ -29,6 +29,7 @@
 
 import gettext
 import os
+import threading
 
 import pkg_resources
 import webob
@@ -38,9 +39,16 @@ from . import conv  # Overridden with real conv during init_module().
 
 __all__ = [
     'Ctx',
+    'FlatTranslations',
+    'get_identity_map',
     'init_module',
     ]
 
+local = threading.local()  # Request-local storage (greenlet-local when gevent has patched threading)
+translators = {}  # Process-wide cache of translators (with their fallbacks), cleared when full
+translators_lock = threading.Lock()
+translators_max_size = 256
+
 
 class Ctx(conv.State):
     _parent = None
@@ -48,9 +56,10 @@ class Ctx(conv.State):
         _lang = None,
         _translator = None,
         conf = None,
+        identity_map = None,
         req = None,
         )
-    env_keys = ('_lang', '_translator')
+    env_keys = ('_lang', '_translator', 'identity_map')
     translators_infos = [
         ('biryani1', os.path.join(pkg_resources.get_distribution('biryani1').location, 'biryani1', 'i18n')),
         ('suq1', os.path.join(pkg_resources.get_distribution('suq1').location, 'suq1', 'i18n')),
@@ -90,6 +99,26 @@ class Ctx(conv.State):
                 ctx_env[key] = value
         return webob.Request.blank(path, environ = env, base_url = base_url, headers = headers, POST = POST, **kw)
 
+    def close_identity_map(self):
+        identity_map = self.identity_map
+        if identity_map is not None:
+            identity_map.clear()
+            if getattr(local, 'identity_map', None) is identity_map:
+                local.identity_map = None
+        self.identity_map = None
+        package_name = self.conf['package_name']
+        if self.req is not None and self.req.environ.get(package_name) is not None:
+            self.req.environ[package_name].pop('identity_map', None)
+
+    @classmethod
+    def from_req(cls, req):
+        """Return the context of a request, created only once per WSGI call and stored in the WSGI environment."""
+        ctx = req.environ.get('suq1.ctx')
+        # When a middleware has copied the environment, the stored context belongs to the original one.
+        if not isinstance(ctx, cls) or ctx.req.environ is not req.environ:
+            ctx = req.environ['suq1.ctx'] = cls(req)
+        return ctx
+
     def get_containing(self, name, depth = 0):
         """Return the n-th (n = ``depth``) context containing attribute named ``name``."""
         ctx_dict = object.__getattribute__(self, '__dict__')
@@ -110,6 +139,35 @@ class Ctx(conv.State):
             return default
         return object.__getattribute__(ctx, name)
 
+    def get_translator(self, languages):
+        """Return the translator (with its fallbacks) for a list of languages names.
+
+        Translators are built once per process for each list of languages (and each translation settings), then shared
+        by every context.
+        """
+        conf = self.conf
+        translators_infos = tuple(
+            tuple(translator_infos)
+            for translator_infos in object.__getattribute__(self, 'translators_infos')
+            )
+        flat_translations = bool(conf.get('flat_translations'))
+        key = (conf['package_name'], conf['i18n_dir'], translators_infos, flat_translations, tuple(languages))
+        translator = translators.get(key)
+        if translator is None:
+            translator = gettext.NullTranslations()
+            for name, i18n_dir in translators_infos:
+                if i18n_dir is not None:
+                    translator = new_translator(name, i18n_dir, languages, fallback = translator)
+            translator = new_translator(conf['package_name'], conf['i18n_dir'], languages, fallback = translator)
+            if flat_translations:
+                translator = FlatTranslations(translator)
+            with translators_lock:
+                if len(translators) >= translators_max_size:
+                    translators.clear()
+                # When another thread has built the same translator meanwhile, use it.
+                translator = translators.setdefault(key, translator)
+        return translator
+
     def iter(self):
         yield self
         parent = object.__getattribute__(self, '_parent')
@@ -166,6 +224,16 @@ class Ctx(conv.State):
             setattr(ctx, name, value)
         return ctx
 
+    def open_identity_map(self):
+        """Attach a new identity map to context and make it the current one until close_identity_map() is called.
+
+        While an identity map is current, documents retrieved by ID or by unique key are loaded only once.
+        """
+        self.identity_map = local.identity_map = {}
+        if self.req is not None:
+            self.req.environ.setdefault(self.conf['package_name'], {})['identity_map'] = self.identity_map
+        return self.identity_map
+
     @property
     def parent(self):
         return object.__getattribute__(self, '_parent')
@@ -179,19 +247,72 @@ class Ctx(conv.State):
                 return gettext.NullTranslations()
             if not isinstance(languages, list):
                 languages = [languages]
-            translator = gettext.NullTranslations()
-            for name, i18n_dir in object.__getattribute__(self, 'translators_infos'):
-                if i18n_dir is not None:
-                    translator = new_translator(name, i18n_dir, languages, fallback = translator)
-            translator = new_translator(self.conf['package_name'], self.conf['i18n_dir'], languages,
-                fallback = translator)
-            self._translator = translator
+            self._translator = self.get_translator(languages)
         return self._translator
 
     @property
     def ungettext(self):
         return self.translator.ungettext
 
+    def warm_translators(self, languages_list = None):
+        """Build at startup the translators of the given lists of languages (by default conf['languages']).
+
+        Each item of languages_list is a list of languages names (or a single language name), like ctx.lang.
+        """
+        if languages_list is None:
+            languages_list = self.conf.get('languages') or []
+        for languages in languages_list:
+            if languages:
+                self.get_translator(languages if isinstance(languages, list) else [languages])
+
+
+class FlatTranslations(gettext.NullTranslations):
+    """Translations merging a chain of translations (with their fallbacks) into a single dictionary
+
+    The first translations of the chain have precedence over their fallbacks. Plural forms keep the plural function of
+    the translations they come from.
+    """
+    def __init__(self, translations):
+        gettext.NullTranslations.__init__(self)
+        chain = []
+        while translations is not None:
+            chain.append(translations)
+            translations = getattr(translations, '_fallback', None)
+        self.messages = messages = {}
+        # For each msgid, list of couples (plural function, translations by plural index), by decreasing precedence
+        self.plural_messages = plural_messages = {}
+        for translations in reversed(chain):
+            catalog = getattr(translations, '_catalog', None)
+            if catalog is None:
+                continue
+            plural_forms = {}
+            for key, value in catalog.iteritems():
+                if isinstance(key, tuple):
+                    msgid, index = key
+                    plural_forms.setdefault(msgid, {})[index] = value
+                else:
+                    messages[key] = value
+            for msgid, forms in plural_forms.iteritems():
+                plural_messages.setdefault(msgid, []).insert(0, (translations.plural, forms))
+
+    def ugettext(self, message):
+        translation = self.messages.get(message)
+        if translation is None:
+            return unicode(message)
+        return translation
+
+    def ungettext(self, msgid1, msgid2, n):
+        for plural, forms in self.plural_messages.get(msgid1, ()):
+            translation = forms.get(plural(n))
+            if translation is not None:
+                return translation
+        return unicode(msgid1) if n == 1 else unicode(msgid2)
+
+
+def get_identity_map():
+    """Return the identity map of the current request or None."""
+    return getattr(local, 'identity_map', None)
+
 
 def init_module(components):
     global conv
@@ -48,111 +48,58 @@ conf = None  # from ??? import conf
 conv = None  # from ??? import conv
 model = None  # from ??? import model
 
+authentication_websocket_url_template = urls.UrlTemplate(u'ws/1/authentication')
+
+# Validators of request parameters, compiled once (they depend on injected components).
+authentication_params_validator = None  # compiled by init_module()
+authentications_params_validator = None  # compiled by init_module()
+new_authentication_session_access_validator = None  # compiled by init_module()
+new_authentication_session_params_validator = None  # compiled by init_module()
+upsert_access_params_validator = None  # compiled by init_module()
+upsert_client_params_validator = None  # compiled by init_module()
+
 
 @wsgihelpers.wsgify
 def api1_new_authentication_session(req):
-    ctx = contexts.Ctx(req)
+    ctx = contexts.Ctx.from_req(req)
     headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
 
     assert req.method == 'POST', req.method
 
-    content_type = req.content_type
-    if content_type is not None:
-        content_type = content_type.split(';', 1)[0].strip()
-    if content_type != 'application/json':
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
-                error = collections.OrderedDict(sorted(dict(
-                    code = 400,  # Bad Request
-                    message = ctx._(u'Bad content-type: {}').format(content_type),
-                    ).iteritems())),
-                method = req.script_name,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
-            )
-
-    inputs, error = conv.pipe(
-        conv.make_input_to_json(object_pairs_hook = collections.OrderedDict),
-        conv.test_isinstance(dict),
-        conv.not_none,
-        )(req.body, state = ctx)
-    if error is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
-                error = collections.OrderedDict(sorted(dict(
-                    code = 400,  # Bad Request
-                    errors = [error],
-                    message = ctx._(u'Invalid JSON in request POST body'),
-                    ).iteritems())),
-                method = req.script_name,
-                params = req.body,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
-            )
+    inputs, response = wsgihelpers.read_body_inputs(ctx, headers = headers)
+    if response is not None:
+        return response
 
-    data, errors = conv.struct(
-        dict(
-            access_token = conv.pipe(
-                conv.test_isinstance(basestring),
-                conv.input_to_uuid_str,
-                model.Access.make_token_to_instance(accept_client = True),
-                conv.not_none,
-                ),
-            ),
-        default = conv.noop,
-        )(inputs, state = ctx)
+    data, errors = new_authentication_session_access_validator(inputs, state = ctx)
     if errors is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
+        return wsgihelpers.respond_data(ctx,
+            wsgihelpers.make_envelope(ctx,
                 context = inputs.get('context'),
-                error = collections.OrderedDict(sorted(dict(
+                error = wsgihelpers.make_error(
                     code = 400,  # Bad Request
                     errors = [errors],
                     message = ctx._(u'Bad authentication parameters in request'),
-                    ).iteritems())),
-                method = req.script_name,
+                    ),
                 params = inputs,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
+                ),
             headers = headers,
             )
 
-    data, errors = conv.struct(
-        dict(
-            access_token = conv.noop,
-            context = conv.test_isinstance(basestring),  # For asynchronous calls
-            synchronizer_token = conv.pipe(
-                conv.test_isinstance(basestring),
-                conv.input_to_uuid_str,
-                conv.not_none,
-                ),
-            ),
-        )(data, state = ctx)
+    data, errors = new_authentication_session_params_validator(data, state = ctx)
     if errors is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
+        return wsgihelpers.respond_data(ctx,
+            wsgihelpers.make_envelope(ctx,
                 context = inputs.get('context'),
-                error = collections.OrderedDict(sorted(dict(
+                error = wsgihelpers.make_error(
                     code = 400,  # Bad Request
                     errors = [errors],
                     message = ctx._(u'Bad parameters in request'),
-                    ).iteritems())),
-                method = req.script_name,
+                    ),
                 params = inputs,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
+                ),
             headers = headers,
             )
 
-    # First, delete expired authentication sessions.
-    model.AuthenticationSession.remove_expired(ctx)
-
     authentication_session = model.AuthenticationSession(
         client_id = data['access_token'].client_id,
         expiration = datetime.datetime.utcnow() + datetime.timedelta(hours = 4),
@@ -168,8 +115,8 @@ def api1_new_authentication_session(req):
         token = authentication_session.token,
         url = u'{}?client_id={}&state={}'.format(conf['weotu.authentication_url'], conf['weotu.id'],
             authentication_session.token),
-        websocket_url = urls.get_full_url(ctx, u'ws/1/authentication', token = authentication_session.token).replace(
-            u'http', u'ws', 1),
+        websocket_url = authentication_websocket_url_template.get_full_url(ctx,
+            token = authentication_session.token).replace(u'http', u'ws', 1),
         ).iteritems()))
     if changed:
         model.zmq_sender.send_multipart([
@@ -181,95 +128,47 @@ def api1_new_authentication_session(req):
                 indent = 2,
                 )).encode('utf-8'),
             ])
-    return wsgihelpers.respond_json(ctx,
-        collections.OrderedDict(sorted(dict(
-            apiVersion = '1.0',
+    return wsgihelpers.respond_data(ctx,
+        wsgihelpers.make_envelope(ctx,
             authentication_session = authentication_session_json,
             context = data['context'],
-            method = req.script_name,
             params = inputs,
-            url = req.url.decode('utf-8'),
-            ).iteritems())),
+            ),
         headers = headers,
+        make_native_data = lambda: wsgihelpers.make_envelope(ctx,
+            authentication_session = collections.OrderedDict(sorted(dict(
+                authentication_session_json,
+                expiration = authentication_session.expiration,
+                ).iteritems())),
+            context = data['context'],
+            params = inputs,
+            ),
         )
 
 
 @wsgihelpers.wsgify
 def api1_upsert_access(req):
-    ctx = contexts.Ctx(req)
+    ctx = contexts.Ctx.from_req(req)
     headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
 
     assert req.method == 'POST', req.method
 
-    content_type = req.content_type
-    if content_type is not None:
-        content_type = content_type.split(';', 1)[0].strip()
-    if content_type != 'application/json':
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
-                error = collections.OrderedDict(sorted(dict(
-                    code = 400,  # Bad Request
-                    message = ctx._(u'Bad content-type: {}').format(content_type),
-                    ).iteritems())),
-                method = req.script_name,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
-            )
-
-    inputs, error = conv.pipe(
-        conv.make_input_to_json(object_pairs_hook = collections.OrderedDict),
-        conv.test_isinstance(dict),
-        conv.not_none,
-        )(req.body, state = ctx)
-    if error is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
-                error = collections.OrderedDict(sorted(dict(
-                    code = 400,  # Bad Request
-                    errors = [error],
-                    message = ctx._(u'Invalid JSON in request POST body'),
-                    ).iteritems())),
-                method = req.script_name,
-                params = req.body,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
-            )
+    inputs, response = wsgihelpers.read_body_inputs(ctx, headers = headers)
+    if response is not None:
+        return response
 
-    data, errors = conv.struct(
-        dict(
-            access_token = conv.pipe(
-                conv.test_isinstance(basestring),
-                conv.input_to_uuid_str,
-                model.Access.make_token_to_instance(accept_client = True),
-                conv.not_none,
-                ),
-            account = conv.pipe(
-                conv.test_isinstance(basestring),
-                conv.cleanup_line,
-                model.Account.str_to_instance,
-                conv.not_none,
-                ),
-            context = conv.test_isinstance(basestring),  # For asynchronous calls
-            ),
-        )(inputs, state = ctx)
+    data, errors = upsert_access_params_validator(inputs, state = ctx)
     if errors is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
+        return wsgihelpers.respond_data(ctx,
+            wsgihelpers.make_envelope(ctx,
                 context = inputs.get('context'),
-                error = collections.OrderedDict(sorted(dict(
+                error = wsgihelpers.make_error(
                     code = 400,  # Bad Request
                     errors = [errors],
                     message = ctx._(u'Bad parameters in request'),
-                    ).iteritems())),
-                method = req.script_name,
+                    ),
                 params = inputs,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
+                ),
             headers = headers,
             )
 
@@ -294,98 +193,43 @@ def api1_upsert_access(req):
             'v1/new_access/',
             unicode(json.dumps(access_json, encoding = 'utf-8', ensure_ascii = False, indent = 2)).encode('utf-8'),
             ])
-    return wsgihelpers.respond_json(ctx,
-        collections.OrderedDict(sorted(dict(
+    return wsgihelpers.respond_data(ctx,
+        wsgihelpers.make_envelope(ctx,
             access = access_json,
-            apiVersion = '1.0',
             context = data['context'],
-            method = req.script_name,
             params = inputs,
-            url = req.url.decode('utf-8'),
-            ).iteritems())),
+            ),
         headers = headers,
+        make_native_data = lambda: wsgihelpers.make_envelope(ctx,
+            access = access.to_native(),
+            context = data['context'],
+            params = inputs,
+            ),
         )
 
 
 @wsgihelpers.wsgify
 def api1_upsert_client(req):
-    ctx = contexts.Ctx(req)
+    ctx = contexts.Ctx.from_req(req)
     headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
 
     assert req.method == 'POST', req.method
 
-    content_type = req.content_type
-    if content_type is not None:
-        content_type = content_type.split(';', 1)[0].strip()
-    if content_type != 'application/json':
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
-                error = collections.OrderedDict(sorted(dict(
-                    code = 400,  # Bad Request
-                    message = ctx._(u'Bad content-type: {}').format(content_type),
-                    ).iteritems())),
-                method = req.script_name,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
-            )
-
-    inputs, error = conv.pipe(
-        conv.make_input_to_json(object_pairs_hook = collections.OrderedDict),
-        conv.test_isinstance(dict),
-        conv.not_none,
-        )(req.body, state = ctx)
-    if error is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
-                error = collections.OrderedDict(sorted(dict(
-                    code = 400,  # Bad Request
-                    errors = [error],
-                    message = ctx._(u'Invalid JSON in request POST body'),
-                    ).iteritems())),
-                method = req.script_name,
-                params = req.body,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
-            headers = headers,
-            )
-    data, errors = conv.struct(
-        dict(
-            access_token = conv.pipe(
-                conv.test_isinstance(basestring),
-                conv.input_to_uuid_str,
-                model.Access.make_token_to_instance(accept_account = True, accept_client = True),
-                conv.not_none,
-                ),
-            blocked = conv.pipe(
-                conv.test_isinstance((bool, int)),
-                conv.anything_to_bool,
-                conv.default(False),
-                ),
-            context = conv.test_isinstance(basestring),  # For asynchronous calls
-            name = conv.pipe(
-                conv.test_isinstance(basestring),
-                conv.cleanup_line,
-                conv.not_none,
-                ),
-            ),
-        )(inputs, state = ctx)
+    inputs, response = wsgihelpers.read_body_inputs(ctx, headers = headers)
+    if response is not None:
+        return response
+    data, errors = upsert_client_params_validator(inputs, state = ctx)
     if errors is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
+        return wsgihelpers.respond_data(ctx,
+            wsgihelpers.make_envelope(ctx,
                 context = inputs.get('context'),
-                error = collections.OrderedDict(sorted(dict(
+                error = wsgihelpers.make_error(
                     code = 400,  # Bad Request
                     errors = [errors],
                     message = ctx._(u'Bad parameters in request'),
-                    ).iteritems())),
-                method = req.script_name,
+                    ),
                 params = inputs,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
+                ),
             headers = headers,
             )
 
@@ -434,23 +278,26 @@ def api1_upsert_client(req):
             unicode(json.dumps(access_json, encoding = 'utf-8', ensure_ascii = False, indent = 2)).encode('utf-8'),
             ])
 
-    return wsgihelpers.respond_json(ctx,
-        collections.OrderedDict(sorted(dict(
-            apiVersion = '1.0',
+    return wsgihelpers.respond_data(ctx,
+        wsgihelpers.make_envelope(ctx,
             client = client_json,
             context = data['context'],
-            method = req.script_name,
             params = inputs,
             token = access.token,
-            url = req.url.decode('utf-8'),
-            ).iteritems())),
+            ),
         headers = headers,
+        make_native_data = lambda: wsgihelpers.make_envelope(ctx,
+            client = client.to_native(),
+            context = data['context'],
+            params = inputs,
+            token = access.token,
+            ),
         )
 
 
 def ws1_authentication(environ, start_response):
-    req = webob.Request(environ)
-    ctx = contexts.Ctx(req)
+    req = wsgihelpers.get_request(environ)
+    ctx = contexts.Ctx.from_req(req)
     try:
         headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
     except webob.exc.HTTPException as response:
@@ -462,33 +309,18 @@ def ws1_authentication(environ, start_response):
         token = params.get('token'),
         )
 
-    data, errors = conv.pipe(
-        conv.struct(
-            dict(
-                token = conv.pipe(
-                    conv.test_isinstance(basestring),
-                    conv.input_to_uuid_str,
-                    model.AuthenticationSession.token_to_instance,
-                    conv.not_none,
-                    ),
-                ),
-            ),
-        conv.rename_item('token', 'authentication_session'),
-        )(inputs, state = ctx)
+    data, errors = authentication_params_validator(inputs, state = ctx)
     if errors is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
+        return wsgihelpers.respond_data(ctx,
+            wsgihelpers.make_envelope(ctx,
                 context = inputs.get('context'),
-                error = collections.OrderedDict(sorted(dict(
+                error = wsgihelpers.make_error(
                     code = 400,  # Bad Request
                     errors = [errors],
                     message = ctx._(u'Bad parameters in request'),
-                    ).iteritems())),
-                method = req.script_name,
+                    ),
                 params = inputs,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
+                ),
             headers = headers,
             )(environ, start_response)
     authentication_session = data['authentication_session']
@@ -534,8 +366,8 @@ class WS1AuthenticationEmitter(ws4py.websocket.WebSocket):
 
 
 def ws1_authentications(environ, start_response):
-    req = webob.Request(environ)
-    ctx = contexts.Ctx(req)
+    req = wsgihelpers.get_request(environ)
+    ctx = contexts.Ctx.from_req(req)
     try:
         headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
     except webob.exc.HTTPException as response:
@@ -544,54 +376,26 @@ def ws1_authentications(environ, start_response):
     content_type = req.content_type
     if content_type is not None:
         content_type = content_type.split(';', 1)[0].strip()
-    if content_type == 'application/json':
-        inputs, error = conv.pipe(
-            conv.make_input_to_json(object_pairs_hook = collections.OrderedDict),
-            conv.test_isinstance(dict),
-            )(req.body, state = ctx)
-        if error is not None:
-            return wsgihelpers.respond_json(ctx,
-                collections.OrderedDict(sorted(dict(
-                    apiVersion = '1.0',
-                    error = collections.OrderedDict(sorted(dict(
-                        code = 400,  # Bad Request
-                        errors = [error],
-                        message = ctx._(u'Invalid JSON in request POST body'),
-                        ).iteritems())),
-                    method = req.script_name,
-                    params = req.body,
-                    url = req.url.decode('utf-8'),
-                    ).iteritems())),
-                headers = headers,
-                )(environ, start_response)
+    if content_type == 'application/json' or content_type in wsgihelpers.msgpack_content_types:
+        inputs, response = wsgihelpers.read_body_inputs(ctx, headers = headers, required = False)
+        if response is not None:
+            return response(environ, start_response)
     else:
         # URL-encoded GET or POST.
         inputs = dict(req.params)
 
-    data, errors = conv.struct(
-        dict(
-            access_token = conv.pipe(
-                conv.test_isinstance(basestring),
-                conv.input_to_uuid_str,
-                model.Access.make_token_to_instance(accept_client = True),
-                conv.not_none,
-                ),
-            ),
-        )(inputs, state = ctx)
+    data, errors = authentications_params_validator(inputs, state = ctx)
     if errors is not None:
-        return wsgihelpers.respond_json(ctx,
-            collections.OrderedDict(sorted(dict(
-                apiVersion = '1.0',
+        return wsgihelpers.respond_data(ctx,
+            wsgihelpers.make_envelope(ctx,
                 context = inputs.get('context'),
-                error = collections.OrderedDict(sorted(dict(
+                error = wsgihelpers.make_error(
                     code = 400,  # Bad Request
                     errors = [errors],
                     message = ctx._(u'Bad parameters in request'),
-                    ).iteritems())),
-                method = req.script_name,
+                    ),
                 params = inputs,
-                url = req.url.decode('utf-8'),
-                ).iteritems())),
+                ),
             headers = headers,
             )(environ, start_response)
 
@@ -668,3 +472,93 @@ def init_module(components):
     global model
     model = components['model']
 
+    # Compile the validators of request parameters once, instead of at each request.
+    global authentication_params_validator
+    authentication_params_validator = conv.pipe(
+        conv.struct(
+            dict(
+                token = conv.pipe(
+                    conv.test_isinstance(basestring),
+                    conv.input_to_uuid_str,
+                    model.AuthenticationSession.token_to_instance,
+                    conv.not_none,
+                    ),
+                ),
+            ),
+        conv.rename_item('token', 'authentication_session'),
+        )
+    global authentications_params_validator
+    authentications_params_validator = conv.struct(
+        dict(
+            access_token = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.input_to_uuid_str,
+                model.Access.make_token_to_instance(accept_client = True),
+                conv.not_none,
+                ),
+            ),
+        )
+    global new_authentication_session_access_validator
+    new_authentication_session_access_validator = conv.struct(
+        dict(
+            access_token = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.input_to_uuid_str,
+                model.Access.make_token_to_instance(accept_client = True),
+                conv.not_none,
+                ),
+            ),
+        default = conv.noop,
+        )
+    global new_authentication_session_params_validator
+    new_authentication_session_params_validator = conv.struct(
+        dict(
+            access_token = conv.noop,
+            context = conv.test_isinstance(basestring),  # For asynchronous calls
+            synchronizer_token = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.input_to_uuid_str,
+                conv.not_none,
+                ),
+            ),
+        )
+    global upsert_access_params_validator
+    upsert_access_params_validator = conv.struct(
+        dict(
+            access_token = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.input_to_uuid_str,
+                model.Access.make_token_to_instance(accept_client = True),
+                conv.not_none,
+                ),
+            account = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.cleanup_line,
+                model.Account.str_to_instance,
+                conv.not_none,
+                ),
+            context = conv.test_isinstance(basestring),  # For asynchronous calls
+            ),
+        )
+    global upsert_client_params_validator
+    upsert_client_params_validator = conv.struct(
+        dict(
+            access_token = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.input_to_uuid_str,
+                model.Access.make_token_to_instance(accept_account = True, accept_client = True),
+                conv.not_none,
+                ),
+            blocked = conv.pipe(
+                conv.test_isinstance((bool, int)),
+                conv.anything_to_bool,
+                conv.default(False),
+                ),
+            context = conv.test_isinstance(basestring),  # For asynchronous calls
+            name = conv.pipe(
+                conv.test_isinstance(basestring),
+                conv.cleanup_line,
+                conv.not_none,
+                ),
+            ),
+        )
@@ -27,6 +27,9 @@
 """Conversion functions"""
 
 
+import datetime
+import struct
+
 from biryani1.base64conv import *
 from biryani1.baseconv import *
 from biryani1.bsonconv import *
@@ -36,6 +39,17 @@ from biryani1.jsonconv import *
 from biryani1.objectconv import *
 from biryani1.states import default_state, State
 from biryani1.uuidconv import *
+from bson import errors as bson_errors, objectid
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+epoch = datetime.datetime(1970, 1, 1)
+msgpack_datetime_ext_code = 2
+msgpack_object_id_ext_code = 1
 
 
 input_to_words = pipe(
@@ -45,9 +59,74 @@ input_to_words = pipe(
     )
 
 
+def datetime_to_microseconds(value):
+    """Convert a datetime to a number of microseconds since epoch. Aware datetimes are converted to UTC first."""
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo = None) - value.utcoffset()
+    delta = value - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def datetime_to_milliseconds(value):
+    """Convert a datetime to a number of milliseconds since epoch, truncated to the second (the format of JSON).
+
+    Naive datetimes give the same result as ``int(calendar.timegm(value.timetuple()) * 1000)``.
+    """
+    return datetime_to_microseconds(value) // 1000000 * 1000
+
+
+def json_default(value):
+    """Encode the ObjectIds & datetimes (like the ones of MessagePack inputs) that JSON doesn't support.
+
+    ObjectIds are encoded to strings and datetimes to numbers of milliseconds since epoch, like in to_json().
+    """
+    if isinstance(value, objectid.ObjectId):
+        return unicode(value)
+    if isinstance(value, datetime.datetime):
+        return datetime_to_milliseconds(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def make_input_to_msgpack(object_pairs_hook = None):
+    """Return a converter that decodes a MessagePack string, with ObjectIds & datetimes decoded natively."""
+    def input_to_msgpack(value, state = None):
+        if value is None:
+            return value, None
+        if state is None:
+            state = default_state
+        if msgpack is None:
+            return value, state._(u'MessagePack is not supported')
+        try:
+            return msgpack.unpackb(value, ext_hook = msgpack_ext_hook, object_pairs_hook = object_pairs_hook,
+                raw = False), None
+        except (bson_errors.InvalidId, msgpack.UnpackException, OverflowError, struct.error, TypeError, ValueError):
+            # InvalidId, OverflowError & struct.error are raised by msgpack_ext_hook() for invalid extension types.
+            return value, state._(u'Invalid MessagePack')
+    return input_to_msgpack
+
+
 def method(method_name, *args, **kwargs):
     def method_converter(value, state = None):
         if value is None:
             return value, None
         return getattr(value, method_name)(state or default_state, *args, **kwargs)
     return method_converter
+
+
+def msgpack_default(value):
+    """Encode ObjectIds & datetimes to MessagePack extension types (used as default function of msgpack.packb)."""
+    if isinstance(value, objectid.ObjectId):
+        return msgpack.ExtType(msgpack_object_id_ext_code, value.binary)
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(msgpack_datetime_ext_code, struct.pack('>q', datetime_to_microseconds(value)))
+    raise TypeError('Unable to encode {!r} to MessagePack'.format(value))
+
+
+def msgpack_ext_hook(code, data):
+    """Decode the MessagePack extension types generated by msgpack_default()."""
+    if code == msgpack_object_id_ext_code:
+        return objectid.ObjectId(data)
+    if code == msgpack_datetime_ext_code:
+        microseconds, = struct.unpack('>q', data)
+        return epoch + datetime.timedelta(microseconds = microseconds)
+    return msgpack.ExtType(code, data)
@@ -26,25 +26,106 @@
 """WSGI Middlewares"""
 
 
+import itertools
+import zlib
+
 import webob
 from weberror.errormiddleware import ErrorMiddleware
 
+from . import wsgihelpers
+
 
 conf = None  # from ??? import conf
 contexts = None  # from ??? import contexts
 model = None  # from ??? import model
 
+compressible_content_types = ('application/javascript', 'application/json', 'application/xml', 'text/')
+
+
+def add_vary_accept_encoding(headers):
+    """Return WSGI response headers whose Vary header includes Accept-Encoding."""
+    vary = [
+        value
+        for name, value in headers
+        if name.lower() == 'vary'
+        ]
+    if any('accept-encoding' in value.lower() or value.strip() == '*' for value in vary):
+        return headers
+    return [
+        (name, value)
+        for name, value in headers
+        if name.lower() != 'vary'
+        ] + [('Vary', ', '.join(vary + ['Accept-Encoding']))]
+
+
+def compressor(app, content_types = None, level = 6, min_size = 1024):
+    """WSGI middleware that compresses responses with gzip or deflate, when client accepts it.
+
+    Only responses whose content type starts with one of content_types and whose length is unknown or at least
+    min_size bytes are compressed. Bodies are compressed incrementally, while the WSGI server iterates over them. The
+    strong ETag of a compressed response is turned into a weak one, because its body differs from the uncompressed one.
+
+    Note: The write() callable returned by start_response is not supported for compressed responses.
+    """
+    if content_types is None:
+        content_types = compressible_content_types
+    content_types = tuple(content_types)
+
+    def compress(environ, start_response):
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return app(environ, start_response)
+        encoding = negotiate_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        compressed = []
+        started = []
+
+        def start_compressed_response(status, headers, exc_info = None):
+            started.append(True)
+            headers_value = dict(
+                (name.lower(), value)
+                for name, value in headers
+                )
+            content_type = headers_value.get('content-type', '').split(';', 1)[0].strip().lower()
+            if not content_type.startswith(content_types):
+                return start_response(status, headers, exc_info)
+            # Even when not compressed, the response may vary according to Accept-Encoding.
+            headers = add_vary_accept_encoding(headers)
+            content_length = headers_value.get('content-length')
+            if encoding is not None and 'content-encoding' not in headers_value \
+                    and status[:3] not in ('204', '304') \
+                    and (content_length is None or content_length.isdigit() and int(content_length) >= min_size):
+                headers = [
+                    (name, weaken_etag(value) if name.lower() == 'etag' else value)
+                    for name, value in headers
+                    if name.lower() != 'content-length'
+                    ]
+                headers.append(('Content-Encoding', encoding))
+                compressed.append(True)
+            return start_response(status, headers, exc_info)
+
+        app_iter = app(environ, start_compressed_response)
+        if compressed:
+            return iter_compressed(app_iter, encoding, level)
+        if started:
+            return app_iter
+        # Application calls start_response lazily, when its first chunk is requested.
+        return iter_lazily_compressed(app_iter, compressed, encoding, level)
+
+    return compress
+
 
 def environment_setter(app):
     """WSGI middleware that sets request-dependant environment."""
     def set_environment(environ, start_response):
-        req = webob.Request(environ)
-        ctx = contexts.Ctx(req)
+        req = wsgihelpers.get_request(environ)
+        ctx = contexts.Ctx.from_req(req)
         model.configure(ctx)
+        ctx.open_identity_map()
         try:
             return app(req.environ, start_response)
         except webob.exc.WSGIHTTPException as wsgi_exception:
             return wsgi_exception(environ, start_response)
+        finally:
+            ctx.close_identity_map()
 
     return set_environment
 
@@ -58,6 +139,77 @@ def init_module(components):
     model = components['model']
 
 
+def iter_compressed(app_iter, encoding, level):
+    """Compress a WSGI iterable, chunk by chunk, using gzip or deflate encoding."""
+    window_bits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    compression_object = zlib.compressobj(level, zlib.DEFLATED, window_bits)
+    try:
+        for chunk in app_iter:
+            if chunk:
+                chunk = compression_object.compress(chunk)
+                if chunk:
+                    yield chunk
+        yield compression_object.flush()
+    finally:
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def iter_lazily_compressed(app_iter, compressed, encoding, level):
+    """Iterate over a WSGI iterable whose start_response is called at its first chunk, compressing it when required.
+
+    compressed is the list that start_response fills when the response must be compressed.
+    """
+    try:
+        chunks = iter(app_iter)
+        first_chunks = list(itertools.islice(chunks, 1))
+        chunks = itertools.chain(first_chunks, chunks)
+        if compressed:
+            chunks = iter_compressed(chunks, encoding, level)
+        for chunk in chunks:
+            yield chunk
+    finally:
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def negotiate_encoding(accept_encoding):
+    """Return the best encoding ("gzip" or "deflate") accepted by an Accept-Encoding header, or None."""
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        name, _, parameters = item.partition(';')
+        name = name.strip().lower()
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            parameter_name, _, parameter_value = parameter.partition('=')
+            if parameter_name.strip().lower() == 'q':
+                try:
+                    quality = float(parameter_value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = quality
+    best_encoding = None
+    best_quality = 0.0
+    for encoding in ('gzip', 'deflate'):
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best_encoding = encoding
+            best_quality = quality
+    return best_encoding
+
+
+def weaken_etag(etag):
+    """Return the weak version of an ETag header value."""
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        return etag
+    return 'W/' + etag
+
+
 def wrap_app(app):
     """Encapsulate main WSGI application within WSGI middlewares."""
     # Set request-dependant environment.
@@ -65,6 +217,11 @@ def wrap_app(app):
 
     # CUSTOM MIDDLEWARE HERE (filtered by error handling middlewares)
 
+    # Compress responses, when compression is enabled by setting it to a dict of compressor() options (maybe empty).
+    compression = conf.get('compression')
+    if compression is not None:
+        app = compressor(app, **compression)
+
     # Handle Python exceptions.
     if not conf['debug']:
         app = ErrorMiddleware(app, conf['global_conf'], **conf['errorware'])
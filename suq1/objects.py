@@ -29,13 +29,36 @@
 
 import collections
 import datetime
+import itertools
+import sys
 
 from bson import objectid
 import pymongo
+import pymongo.errors
 
 
 contexts = None  # from ??? import contexts
 conv = None  # from ??? import conv
+# Private class attributes used as per-class caches or settings, that SlottedMapperType doesn't turn into slots
+slotted_class_attributes_name = frozenset([
+    '_attributes_serializer',
+    '_attributes_to_json',
+    '_collection',
+    '_extra_bson',
+    '_fields_default',
+    '_fields_name',
+    '_json_dict_to_attributes',
+    '_native_attributes_serializer',
+    '_partial_classes',
+    '_private_attributes_default',
+    ])
+
+
+# Exceptions
+
+
+class ConflictError(Exception):
+    """Raised when a document to update has been modified since it was loaded"""
 
 
 # Level-1 Classes
@@ -44,11 +67,17 @@ conv = None  # from ??? import conv
 class Cursor(pymongo.cursor.Cursor):
     """A MongoDB cursor that returns mapped documents instead of BSON documents"""
     document_class = None
+    prefetch_batch_size = 100
+    prefetched_documents = None  # Mapped documents whose relations have already been resolved
+    relations_name = ()  # Names of the relations to prefetch
 
     def __getitem__(self, index):
         doc = super(Cursor, self).__getitem__(index)
         if isinstance(doc, dict):
-            return self.document_class.from_bson(doc)
+            document = self.document_class.from_bson(doc)
+            if self.relations_name:
+                self.document_class.prefetch_relations([document], self.relations_name)
+            return document
         else:
             return doc
 
@@ -56,23 +85,137 @@ class Cursor(pymongo.cursor.Cursor):
         clone = super(Cursor, self).clone()
         clone.__class__ = self.__class__
         clone.document_class = self.document_class
+        clone.relations_name = self.relations_name
         return clone
 
     def next(self):
-        next = super(Cursor, self).next()
-        return self.document_class.from_bson(next)
+        if not self.relations_name:
+            next = super(Cursor, self).next()
+            return self.document_class.from_bson(next)
+        if not self.prefetched_documents:
+            documents = []
+            try:
+                while len(documents) < self.prefetch_batch_size:
+                    documents.append(self.document_class.from_bson(super(Cursor, self).next()))
+            except StopIteration:
+                if not documents:
+                    raise
+            self.document_class.prefetch_relations(documents, self.relations_name)
+            self.prefetched_documents = collections.deque(documents)
+        return self.prefetched_documents.popleft()
+
+    def prefetch(self, *relations_name):
+        """Resolve the given relations of the documents by batches, using one query per relation and batch.
+
+        >>> for access in Access.find().prefetch('account', 'client'):
+        ...     print access.individual  # No query here
+        """
+        self.relations_name = self.relations_name + relations_name
+        return self
+
+    def rewind(self):
+        self.prefetched_documents = None
+        return super(Cursor, self).rewind()
 
 
 class Initable(object):
+    """Mixin that initializes attributes from keyword arguments and tracks the attributes changed since last save"""
+    __slots__ = ('_changes',)  # Stored outside of __dict__, to be ignored by to_bson() & object_to_clean_dict().
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        self.get_changes()[name] = False
+
+    def __getstate__(self):
+        # Without __getstate__, pickle protocols < 2 refuse to pickle instances of classes with __slots__.
+        try:
+            dict_state = object.__getattribute__(self, '__dict__').copy()
+        except AttributeError:
+            dict_state = None
+        slots_state = {}
+        for cls in type(self).__mro__:
+            slots_name = cls.__dict__.get('__slots__', ())
+            for name in (slots_name,) if isinstance(slots_name, basestring) else slots_name:
+                if name in ('__dict__', '__weakref__'):
+                    continue
+                try:
+                    slots_state[name] = object.__getattribute__(self, name)
+                except AttributeError:
+                    pass
+        return dict_state, slots_state
+
     def __init__(self, **attributes):
         if attributes:
             self.set_attributes(**attributes)
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('__'):
+            self.get_changes()[name] = True
+
+    def __setstate__(self, state):
+        dict_state, slots_state = state
+        if dict_state:
+            object.__getattribute__(self, '__dict__').update(dict_state)
+        # Use object.__setattr__ to bypass the tracking of changes.
+        for name, value in slots_state.iteritems():
+            object.__setattr__(self, name, value)
+
+    def changes_to_update(self, bson, old_bson = None):
+        """Return a MongoDB update that sets (or unsets) only the attributes of bson changed since last save.
+
+        When old_bson (the stored document) is given, the update is computed by comparing it with bson. Otherwise it
+        is computed from the attributes assigned or deleted since last save, so in-place mutations of an attribute
+        (like ``self.words.append(word)``) are not detected.
+        """
+        set_items = {}
+        unset_items = {}
+        if old_bson is not None:
+            for name, value in bson.iteritems():
+                if name != '_id' and (name not in old_bson or old_bson[name] != value):
+                    set_items[name] = value
+            for name in old_bson:
+                if name not in bson:
+                    unset_items[name] = 1
+        else:
+            for name, is_set in self.get_changes().iteritems():
+                if name == '_id':
+                    continue
+                if is_set:
+                    if name in bson:
+                        set_items[name] = bson[name]
+                elif name not in bson:
+                    unset_items[name] = 1
+        update = {}
+        if set_items:
+            update['$set'] = set_items
+        if unset_items:
+            update['$unset'] = unset_items
+        return update
+
+    def clear_changes(self):
+        object.__setattr__(self, '_changes', {})
+
+    def get_changes(self):
+        """Return a dict mapping the name of each attribute changed since last save to False when it has been deleted
+        and to True otherwise.
+        """
+        try:
+            return object.__getattribute__(self, '_changes')
+        except AttributeError:
+            changes = {}
+            object.__setattr__(self, '_changes', changes)
+            return changes
+
+    @classmethod
+    def get_attribute_default(cls, name):
+        return getattr(cls, name, UnboundLocalError)
+
     def set_attributes(self, **attributes):
         """Set given attributes and return a boolean stating whether existing attributes have changed."""
         changed = False
         for name, value in attributes.iteritems():
-            if value is getattr(self.__class__, name, UnboundLocalError):
+            if value is self.get_attribute_default(name):
                 if value is not getattr(self, name, UnboundLocalError):
                     delattr(self, name)
                     changed = True
@@ -83,41 +226,132 @@ class Initable(object):
 
 
 class JsonMonoClassMapper(object):
+    """Mixin that converts objects to & from JSON
+
+    The converters returned by class methods get_attribute_to_json_converters() & get_json_to_attribute_converters()
+    are compiled once per class. When get_attribute_to_json_converters() or rename_attribute_to_json_items() is
+    overridden as an instance method, the attributes_to_json converter is built for each instance instead.
+    """
+    __slots__ = ()
+    _attributes_serializer = None  # class attribute used as cache for class method get_attributes_serializer()
+    _attributes_to_json = None  # class attribute used as cache for class method get_attributes_to_json()
+    _json_dict_to_attributes = None  # class attribute used as cache for class method json_dict_to_attributes()
+    _native_attributes_serializer = None  # class attribute used as cache for class method get_attributes_serializer()
+
     @property
     def attributes_to_json(self):
-        return conv.pipe(
-            self.rename_attribute_to_json_items,
-            conv.struct(
-                self.get_attribute_to_json_converters(),
-                default = conv.noop,
-                skip_missing_items = True,
-                ),
-            )
+        converter = self.get_attributes_to_json()
+        if converter is None:
+            # Hooks are instance methods.
+            converter = conv.pipe(
+                self.rename_attribute_to_json_items,
+                conv.struct(
+                    self.get_attribute_to_json_converters(),
+                    default = conv.noop,
+                    skip_missing_items = True,
+                    ),
+                )
+        return converter
 
     @classmethod
     def from_json(cls, bson, state = None):
         return conv.check(cls.json_to_instance)(bson, state = state or conv.default_state)
 
-    def get_attribute_to_json_converters(self):
+    @classmethod
+    def get_attribute_to_json_converters(cls):
         return {}
 
+    @classmethod
+    def get_attributes_json_type(cls):
+        """Return a dict giving the JSON type of the attributes that turn_to_json_attributes() must convert.
+
+        Known types are:
+        * ``'datetime'``: datetime converted to a number of milliseconds since epoch
+        * ``'hidden'``: attribute removed from JSON
+        * ``'id'``: ObjectId converted to unicode and renamed to ``id``
+        * ``'object_id'``: ObjectId converted to unicode
+
+        When None, turn_to_json_attributes() only removes the attributes whose value is the default one.
+
+        to_native() keeps datetimes & ObjectIds unconverted, but still hides & renames attributes.
+        """
+        return None
+
+    @classmethod
+    def get_attributes_serializer(cls, native = False):
+        cache_name = '_native_attributes_serializer' if native else '_attributes_serializer'
+        serializer = cls.__dict__.get(cache_name)
+        if serializer is None:
+            serializer = make_attributes_serializer(cls, native = native)
+            setattr(cls, cache_name, serializer)
+        return serializer
+
+    @classmethod
+    def get_attributes_to_json(cls):
+        """Return the attributes_to_json converter compiled for class, or None when its hooks are instance methods."""
+        converter = cls.__dict__.get('_attributes_to_json')
+        if converter is None:
+            if is_instance_method(cls, 'get_attribute_to_json_converters') or \
+                    is_instance_method(cls, 'rename_attribute_to_json_items'):
+                converter = False
+            else:
+                converter = conv.pipe(
+                    cls.rename_attribute_to_json_items,
+                    conv.struct(
+                        cls.get_attribute_to_json_converters(),
+                        default = conv.noop,
+                        skip_missing_items = True,
+                        ),
+                    )
+            cls._attributes_to_json = converter
+        return converter or None
+
     @classmethod
     def get_json_to_attribute_converters(cls):
         return {}
 
+    @classmethod
+    def instances_to_json(cls, instances, state = None):
+        """Convert a sequence of instances (a list, a cursor, etc) to a list of JSON dicts.
+
+        The converters are looked up once per class of instance, instead of once per instance.
+        """
+        if state is None:
+            state = conv.default_state
+        converter_by_class = {}
+        instances_json = []
+        for instance in instances:
+            instance_class = instance.__class__
+            converter = converter_by_class.get(instance_class)
+            if converter is None:
+                if has_default_turn_to_json(instance_class) and instance_class.get_attributes_to_json() is not None:
+                    converter = conv.check(conv.pipe(
+                        instance_class.get_attributes_serializer(),
+                        instance_class.get_attributes_to_json(),
+                        ))
+                else:
+                    # Class customizes its conversion to JSON => Use it.
+                    converter = conv.check(conv.method('turn_to_json'))
+                converter_by_class[instance_class] = converter
+            instances_json.append(converter(instance, state = state))
+        return instances_json
+
     @classmethod
     def json_dict_to_attributes(cls, value, state = None):
         if state is None:
             state = conv.default_state
-        return conv.pipe(
-            conv.struct(
-                cls.get_json_to_attribute_converters(),
-                # default = None,  # For security reasons, don't accept JSON items without converters.
-                skip_missing_items = True,
-                ),
-            cls.json_dict_to_attributes_phase2,
-            cls.rename_json_to_attribute_items,
-            )(value, state = state)
+        converter = cls.__dict__.get('_json_dict_to_attributes')
+        if converter is None:
+            cls._json_dict_to_attributes = converter = conv.pipe(
+                conv.struct(
+                    cls.get_json_to_attribute_converters(),
+                    # default = None,  # For security reasons, don't accept JSON items without converters.
+                    skip_missing_items = True,
+                    ),
+                cls.json_dict_to_attributes_phase2,
+                cls.rename_json_to_attribute_items,
+                )
+        return converter(value, state = state)
 
     @classmethod
     def json_dict_to_attributes_phase2(cls, value, state = None):
@@ -153,6 +387,18 @@ class JsonMonoClassMapper(object):
     def to_json(self, state = None):
         return conv.check(conv.method('turn_to_json'))(self, state = state or conv.default_state)
 
+    def to_native(self, state = None):
+        """Convert object like to_json(), but keeping its datetimes & ObjectIds (for MessagePack responses).
+
+        When the class customizes turn_to_json() or turn_to_json_attributes(), return the result of to_json().
+        """
+        if not has_default_turn_to_json(type(self)):
+            return self.to_json(state = state)
+        return conv.check(conv.pipe(
+            self.get_attributes_serializer(native = True),
+            self.attributes_to_json,
+            ))(self, state = state or conv.default_state)
+
     def turn_to_json(self, state):
         return conv.pipe(
             conv.method('turn_to_json_attributes'),
@@ -160,7 +406,7 @@ class JsonMonoClassMapper(object):
             )(self, state = state)
 
     def turn_to_json_attributes(self, state):
-        return conv.object_to_clean_dict(self, state = state)
+        return self.get_attributes_serializer()(self, state = state)
 
 
 class Mapper(object):
@@ -183,15 +429,218 @@ class Mapper(object):
         return self.__dict__
 
 
+class PartialMapper(object):
+    """Mixin for documents loaded using a projection
+
+    Reading an attribute that has not been loaded, loads all the missing attributes of the document (and turns it into
+    an instance of its full class), instead of returning the default value of the class. The attributes truncated by a
+    projection operator (like ``{'words': {'$slice': 5}}``) are then reloaded too, overwriting their truncated value.
+
+    Don't use this mixin directly: it is used by Wrapper.get_partial_class().
+    """
+    __slots__ = ()
+    full_class = None
+    projection_inclusive = False  # When true, only attributes in projection_names have been loaded.
+    projection_names = frozenset()
+    projection_truncated_names = frozenset()  # Attributes loaded using a projection operator, like $slice
+
+    def __getattribute__(self, name):
+        if not name.startswith('__') and type(self).is_unloaded(name) and not has_instance_attribute(self, name):
+            self.load_unloaded_attributes()
+        return object.__getattribute__(self, name)
+
+    @classmethod
+    def is_unloaded(cls, name):
+        if not cls.projection_inclusive:
+            return name in cls.projection_names
+        if name in cls.projection_names:
+            return False
+        if name == '_id':
+            return True
+        fields_name = getattr(cls, '_fields_name', None)
+        if fields_name is not None:
+            # Slotted mapper
+            return name in fields_name
+        if name.startswith('_') or name in cls.non_field_names or name in PartialMapper.__dict__:
+            return False
+        value = getattr(cls, name, UnboundLocalError)
+        return value is UnboundLocalError or not (callable(value) or hasattr(value, '__get__'))
+
+    def load_unloaded_attributes(self):
+        cls = type(self)
+        if not has_instance_attribute(self, '_id') or object.__getattribute__(self, '_id') is None:
+            raise AttributeError('Unloaded attributes of a document without _id can\'t be loaded')
+        fields = dict(
+            (name, not cls.projection_inclusive)
+            for name in cls.projection_names
+            )
+        if not cls.projection_inclusive:
+            for name in cls.projection_truncated_names:
+                fields[name] = True
+        bson = cls.full_class.get_collection().find_one(object.__getattribute__(self, '_id'), fields = fields)
+        if bson is None:
+            raise LookupError(u'Document {} has been deleted: its unloaded attributes can\'t be loaded'.format(
+                object.__getattribute__(self, '_id')))
+        # Don't overwrite the attributes modified since loading, except the truncated ones.
+        truncated_bson = dict(
+            (name, bson[name])
+            for name in cls.projection_truncated_names
+            if name in bson
+            )
+        if isinstance(self, SlottedMapper):
+            self.update_from_bson(bson, overwrite = False)
+            self.update_from_bson(truncated_bson)
+        else:
+            self_dict = object.__getattribute__(self, '__dict__')
+            for name, value in bson.iteritems():
+                self_dict.setdefault(name, value)
+            self_dict.update(truncated_bson)
+        object.__setattr__(self, '__class__', cls.full_class)
+
+    def to_bson(self):
+        self.load_unloaded_attributes()
+        return self.to_bson()
+
+
+class SlottedMapperType(type):
+    """Metaclass of slotted mappers, that turns the attributes declared in class into slots
+
+    Every public data attribute (except the ones listed in non_field_names) of the class and of its bases and _id become
+    slots, whose default value is the value of the class attribute. Private data attributes (like the caches of
+    relations) also become slots with a default value, but they are not document fields. The private class attributes
+    used as per-class caches (listed in slotted_class_attributes_name) stay class attributes.
+    """
+    def __new__(mcs, name, bases, namespace):
+        if '__slots__' in namespace:
+            return super(SlottedMapperType, mcs).__new__(mcs, name, bases, namespace)
+        non_field_names = namespace.get('non_field_names')
+        if non_field_names is None:
+            non_field_names = ()
+            for base in bases:
+                non_field_names = getattr(base, 'non_field_names', non_field_names)
+        fields_default = {}
+        private_attributes_default = {}
+        inherited_slots_name = set()
+
+        def add_attribute(attribute_name, value):
+            # Return whether the attribute is a field or a private data attribute that becomes a slot.
+            if attribute_name.startswith('__') or attribute_name in slotted_class_attributes_name \
+                    or attribute_name in non_field_names or hasattr(value, '__get__'):
+                return False
+            if attribute_name == '_id' or not attribute_name.startswith('_'):
+                fields_default[attribute_name] = value
+            else:
+                private_attributes_default[attribute_name] = value
+            return True
+
+        for base in reversed(bases):
+            for klass in reversed(base.__mro__):
+                fields_default.update(klass.__dict__.get('_fields_default') or {})
+                private_attributes_default.update(klass.__dict__.get('_private_attributes_default') or {})
+                inherited_slots_name.update(klass.__dict__.get('__slots__') or ())
+                for attribute_name, value in klass.__dict__.iteritems():
+                    add_attribute(attribute_name, value)
+        for attribute_name, value in namespace.items():
+            if add_attribute(attribute_name, value):
+                del namespace[attribute_name]
+        namespace['__slots__'] = tuple(sorted(
+            set(fields_default).union(private_attributes_default, ['_extra_bson']).difference(inherited_slots_name)
+            ))
+        namespace['_fields_default'] = fields_default
+        namespace['_fields_name'] = frozenset(fields_default)
+        namespace['_private_attributes_default'] = private_attributes_default
+        return super(SlottedMapperType, mcs).__new__(mcs, name, bases, namespace)
+
+
+class SlottedMapper(object):
+    """Mixin that implements a compact MongoDB object mapper, that stores attributes in slots instead of a __dict__
+
+    Declare attributes as class attributes, like for Mapper: The metaclass turns them into slots. Use this mixin instead
+    of Mapper, before Initable and the other mixins in class bases. Every base class must define __slots__, otherwise
+    instances still get a __dict__.
+
+    Attributes of BSON documents that have not been declared are kept in _extra_bson.
+    """
+    __metaclass__ = SlottedMapperType
+    __slots__ = ()
+    _fields_default = {}  # Default values of slots, set by metaclass
+    _fields_name = frozenset()  # Names of the slots that are document fields, set by metaclass
+    _private_attributes_default = {}  # Default values of the slots that are not document fields, set by metaclass
+
+    def __getattr__(self, name):
+        # Called only when attribute is not found, ie for unset slots.
+        cls = type(self)
+        try:
+            return cls._fields_default[name]
+        except KeyError:
+            pass
+        try:
+            return cls._private_attributes_default[name]
+        except KeyError:
+            raise AttributeError('{!r} object has no attribute {!r}'.format(type(self).__name__, name))
+
+    @classmethod
+    def from_bson(cls, bson):
+        if bson is None:
+            return None
+        self = cls.__new__(cls)
+        self.update_from_bson(bson)
+        return self
+
+    @classmethod
+    def get_attribute_default(cls, name):
+        return cls._fields_default.get(name, cls._private_attributes_default.get(name, UnboundLocalError))
+
+    def iter_set_attributes(self):
+        """Iterate over the names & values of the slots that are set (like the items of __dict__)."""
+        for name in self._fields_default:
+            try:
+                yield name, object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+
+    def to_bson(self):
+        bson = dict(self.iter_set_attributes())
+        try:
+            bson.update(object.__getattribute__(self, '_extra_bson'))
+        except AttributeError:
+            pass
+        return bson
+
+    def update_from_bson(self, bson, overwrite = True):
+        # Use object.__setattr__ to bypass the tracking of changes done by Initable.
+        fields_name = self._fields_name
+        extra_bson = None
+        for name, value in bson.iteritems():
+            if name in fields_name:
+                if overwrite or not has_instance_attribute(self, name):
+                    object.__setattr__(self, name, value)
+            else:
+                if extra_bson is None:
+                    try:
+                        extra_bson = object.__getattribute__(self, '_extra_bson')
+                    except AttributeError:
+                        extra_bson = {}
+                        object.__setattr__(self, '_extra_bson', extra_bson)
+                if overwrite:
+                    extra_bson[name] = value
+                else:
+                    extra_bson.setdefault(name, value)
+
+
 class Wrapper(object):
     """Mixin that wraps MongoDB commands
 
     Use it in conjuction with a document mapper mixin.
     """
+    __slots__ = ()
     _collection = None  # class attribute used as cache for class method get_collection()
     _id = None
+    _partial_classes = None  # class attribute used as cache for class method get_partial_class()
     collection_name = None  # class constant to override
     db = None
+    identity_keys = ()  # class constant to override: names of unique attributes (besides _id) used by identity map
+    non_field_names = ('collection_name', 'db', 'identity_keys', 'non_field_names')  # public class constants
 
     @classmethod
     def count(cls):
@@ -201,6 +650,7 @@ class Wrapper(object):
         id = self._id
         assert id is not None
         self.remove(id, *args, **kwargs)
+        self.forget(id)
         del self._id  # Mark as deleted.
         return id
 
@@ -225,12 +675,42 @@ class Wrapper(object):
         cursor = cls.get_collection().find(*args, **kwargs)
         assert cursor.__class__ is pymongo.cursor.Cursor
         cursor.__class__ = Cursor
-        cursor.document_class = cls
+        cursor.document_class = cls.get_partial_class(kwargs['fields'] if 'fields' in kwargs
+            else args[1] if len(args) > 1 else None)
         return cursor
 
     @classmethod
     def find_one(cls, *args, **kwargs):
-        return cls.from_bson(cls.get_collection().find_one(*args, **kwargs))
+        identity_map = contexts.get_identity_map()
+        fields = kwargs['fields'] if 'fields' in kwargs else args[1] if len(args) > 1 else None
+        if fields is not None:
+            # Don't map partial documents.
+            return cls.get_partial_class(fields).from_bson(cls.get_collection().find_one(*args, **kwargs))
+        if identity_map is None:
+            return cls.from_bson(cls.get_collection().find_one(*args, **kwargs))
+        key = cls.get_identity_key(*args, **kwargs)
+        if key is not None:
+            self = identity_map.get(key)
+            # Ensure that unique attribute has not been modified since document was mapped.
+            if self is not None and (key[1] == '_id' or getattr(self, key[1]) == key[2]):
+                return self
+        self = cls.from_bson(cls.get_collection().find_one(*args, **kwargs))
+        if self is None:
+            return None
+        return cls.remember(self)
+
+    @classmethod
+    def forget(cls, id):
+        """Remove document with given ID from the identity map of the current request."""
+        identity_map = contexts.get_identity_map()
+        if identity_map is None:
+            return
+        self = identity_map.pop((cls, '_id', id), None)
+        if self is not None:
+            for name in cls.identity_keys:
+                key = (cls, name, getattr(self, name))
+                if identity_map.get(key) is self:
+                    del identity_map[key]
 
     @classmethod
     def get_collection(cls):
@@ -246,6 +726,77 @@ class Wrapper(object):
     def get_collection_name(cls):
         return cls.collection_name
 
+    @classmethod
+    def get_identity_key(cls, *args, **kwargs):
+        """Return the key in identity map of the document retrieved by find_one(*args, **kwargs) or None."""
+        if len(args) != 1 or args[0] is None or set(kwargs).difference(['as_class']):
+            return None
+        spec_or_id = args[0]
+        if not isinstance(spec_or_id, dict):
+            return (cls, '_id', spec_or_id)
+        if len(spec_or_id) != 1:
+            return None
+        name, value = spec_or_id.items()[0]
+        if name != '_id' and name not in cls.identity_keys or value is None or isinstance(value, (dict, list)):
+            return None
+        return (cls, name, value)
+
+    @classmethod
+    def get_partial_class(cls, fields):
+        """Return the class of the documents loaded using given projection (list of names or dict)."""
+        if fields is None:
+            return cls
+        if isinstance(fields, dict):
+            included_names = set(
+                name
+                for name, value in fields.iteritems()
+                if value and not isinstance(value, dict)
+                )
+            excluded_names = set(
+                name
+                for name, value in fields.iteritems()
+                if not value
+                )
+            truncated_names = frozenset(
+                name
+                for name, value in fields.iteritems()
+                if value and isinstance(value, dict)
+                )
+        else:
+            included_names = set(fields) or set(['_id'])
+            excluded_names = set()
+            truncated_names = frozenset()
+        if included_names:
+            if '_id' not in excluded_names:
+                included_names.add('_id')
+            key = (True, frozenset(included_names), truncated_names)
+        elif excluded_names or truncated_names:
+            key = (False, frozenset(excluded_names), truncated_names)
+        else:
+            return cls
+        partial_classes = cls.__dict__.get('_partial_classes')
+        if partial_classes is None:
+            cls._partial_classes = partial_classes = {}
+        partial_class = partial_classes.get(key)
+        if partial_class is None:
+            partial_classes[key] = partial_class = type(cls.__name__, (PartialMapper, cls), dict(
+                __module__ = cls.__module__,
+                __slots__ = (),
+                full_class = cls,
+                projection_inclusive = key[0],
+                projection_names = key[1],
+                projection_truncated_names = key[2],
+                ))
+        return partial_class
+
+    @classmethod
+    def get_relations(cls):
+        """Return a dict mapping the name of each relation to the name of its ID attribute and to its related class.
+
+        The related document of relation "xxx" is cached in attribute "_xxx".
+        """
+        return {}
+
     @classmethod
     def group(cls, *args, **kwargs):
         return cls.get_collection().group(*args, **kwargs)
@@ -258,6 +809,35 @@ class Wrapper(object):
     def map_reduce(cls, *args, **kwargs):
         return cls.get_collection().map_reduce(*args, **kwargs)
 
+    @classmethod
+    def prefetch_relations(cls, documents, relations_name):
+        """Load the related documents of given relations for all documents, using one query per relation."""
+        relations = cls.get_relations()
+        for relation_name in relations_name:
+            id_name, related_class = relations[relation_name]
+            ids = set(getattr(document, id_name) for document in documents)
+            ids.discard(None)
+            related_by_id = dict(
+                (related._id, related)
+                for related in related_class.find({'_id': {'$in': list(ids)}}, as_class = collections.OrderedDict)
+                ) if ids else {}
+            cache_name = '_' + relation_name
+            for document in documents:
+                setattr(document, cache_name, related_by_id.get(getattr(document, id_name)))
+
+    @classmethod
+    def remember(cls, self):
+        """Add document to the identity map of the current request and return the document mapped with the same ID."""
+        identity_map = contexts.get_identity_map()
+        if identity_map is None or self._id is None:
+            return self
+        self = identity_map.setdefault((cls, '_id', self._id), self)
+        for name in cls.identity_keys:
+            value = getattr(self, name)
+            if value is not None:
+                identity_map[(cls, name, value)] = self
+        return self
+
     @classmethod
     def remove(cls, *args, **kwargs):
         return cls.get_collection().remove(*args, **kwargs)
@@ -280,11 +860,21 @@ class Wrapper(object):
 
 
 class SmartWrapper(Wrapper):
+    __slots__ = ()
     draft_id = None
 
     def after_delete(self, ctx, old_bson, *args, **kwargs):
         pass
 
+    @classmethod
+    def after_delete_many(cls, ctx, old_bsons, *args, **kwargs):
+        """Called by delete_many() once the documents have been removed.
+
+        Override it to handle the whole batch at once, instead of calling after_delete() for each document.
+        """
+        for old_bson in old_bsons:
+            cls.from_bson(old_bson).after_delete(ctx, old_bson, *args, **kwargs)
+
     def after_upsert(self, ctx, old_bson, bson, *args, **kwargs):
         pass
 
@@ -294,6 +884,15 @@ class SmartWrapper(Wrapper):
     def before_delete(self, ctx, old_bson, *args, **kwargs):
         pass
 
+    @classmethod
+    def before_delete_many(cls, ctx, old_bsons, *args, **kwargs):
+        """Called by delete_many() before the documents are removed.
+
+        Override it to handle the whole batch at once, instead of calling before_delete() for each document.
+        """
+        for old_bson in old_bsons:
+            cls.from_bson(old_bson).before_delete(ctx, old_bson, *args, **kwargs)
+
     def before_upsert(self, ctx, old_bson, bson, *args, **kwargs):
         self.draft_id = bson['draft_id'] = objectid.ObjectId()
 
@@ -307,37 +906,171 @@ class SmartWrapper(Wrapper):
             self.before_delete(ctx, old_bson, *args, **kwargs)
             self.remove(id, *args, **kwargs)
             self.after_delete(ctx, old_bson, *args, **kwargs)
+        self.forget(id)
         del self._id  # Mark as deleted.
         return id
 
+    @classmethod
+    def delete_many(cls, ctx, spec, *args, **kwargs):
+        """Delete all the documents matching spec using a single remove and return their IDs."""
+        assert isinstance(ctx, contexts.Ctx)
+        old_bsons = [
+            dict(old_bson)
+            for old_bson in cls.get_collection().find(spec, as_class = collections.OrderedDict)
+            ]
+        if not old_bsons:
+            return []
+        cls.before_delete_many(ctx, old_bsons, *args, **kwargs)
+        ids = [old_bson['_id'] for old_bson in old_bsons]
+        cls.remove({'_id': {'$in': ids}}, *args, **kwargs)
+        cls.after_delete_many(ctx, old_bsons, *args, **kwargs)
+        for id in ids:
+            cls.forget(id)
+        return ids
+
+    @classmethod
+    def get_versioning_attributes_name(cls):
+        """Return the names of the attributes that before_upsert() sets at each write."""
+        return ('draft_id',)
+
     def save(self, ctx, *args, **kwargs):
         # Override the dafault save method to return True when bson has changed and False otherwise.
         # Since to_bson may return a copy of account's __dict__, we need to add _id to original object.
+        # When keyword argument optimistic is true, the existing document is not read before being replaced: Its
+        # draft_id is used as a version number and ConflictError is raised when it differs from the object's one.
+        # In this mode, the document is always written and before_upsert receives None as old_bson.
+        # When keyword argument partial is true, an existing document is updated using $set & $unset with only the
+        # attributes changed, instead of being replaced. The object must be Initable. The changes are computed by
+        # comparing with the existing document, except in optimistic mode, where only the attributes assigned or
+        # deleted since last save are written: In-place mutations (like self.words.append(word)) are then lost.
         assert isinstance(ctx, contexts.Ctx)
+        optimistic = kwargs.pop('optimistic', False)
+        partial = kwargs.pop('partial', False)
+        assert not partial or isinstance(self, Initable)
         bson = self.to_bson() or {}
         collection = self.get_collection()
         id = bson.get('_id')
         if id is None:
             old_bson = None
+        elif optimistic:
+            draft_id = bson.get('draft_id')
+            # before_upsert() changes draft_id (and other versioning attributes): Keep their previous values, to
+            # restore them on conflict, otherwise every retry would conflict again.
+            versioning_attributes_name = self.get_versioning_attributes_name()
+            previous_attributes = dict(
+                (name, object.__getattribute__(self, name))
+                for name in versioning_attributes_name
+                if has_instance_attribute(self, name)
+                )
+            previous_changes = dict(self.get_changes()) if isinstance(self, Initable) else None
+            self.before_upsert(ctx, None, bson, *args, **kwargs)
+            # No existing document to compare with: Partial update uses the tracked changes, that ignore in-place
+            # mutations.
+            old_bson = collection.find_and_modify(dict(_id = id, draft_id = draft_id),
+                self.changes_to_update(bson) if partial else bson)
+            if old_bson is None:
+                for name in versioning_attributes_name:
+                    if name in previous_attributes:
+                        object.__setattr__(self, name, previous_attributes[name])
+                    elif has_instance_attribute(self, name):
+                        object.__delattr__(self, name)
+                if previous_changes is not None:
+                    object.__setattr__(self, '_changes', previous_changes)
+                raise ConflictError(u'Document {} of collection {} has been modified or deleted since draft {}'.format(
+                    id, collection.name, draft_id))
+            if isinstance(self, Initable):
+                self.clear_changes()
+            self.after_upsert(ctx, old_bson, bson, *args, **kwargs)
+            return True
         else:
             old_bson = collection.find_one(id, as_class = collections.OrderedDict)
             if old_bson is not None:
                 old_bson = dict(old_bson)
                 self.before_compare(ctx, old_bson, bson)
                 if bson == old_bson:
+                    if isinstance(self, Initable):
+                        self.clear_changes()
                     return False
         self.before_upsert(ctx, old_bson, bson, *args, **kwargs)
-        collection.save(bson, *args, **kwargs)
+        if partial and old_bson is not None:
+            collection.update(dict(_id = id), self.changes_to_update(bson, old_bson = old_bson), *args, **kwargs)
+        else:
+            collection.save(bson, *args, **kwargs)
         if id is None:
             self._id = bson['_id']
+        if isinstance(self, Initable):
+            self.clear_changes()
         self.after_upsert(ctx, old_bson, bson, *args, **kwargs)
         return True
 
+    @classmethod
+    def save_many(cls, ctx, instances, *args, **kwargs):
+        """Save several objects, loading their existing documents with one query and writing them with one unordered
+        bulk operation.
+
+        Hooks are called for each object, like in save(). Return a list of booleans stating, for each object, whether
+        its document has changed. When some writes fail, the hooks of the documents written are called before
+        BulkWriteError is re-raised.
+        """
+        assert isinstance(ctx, contexts.Ctx)
+        write_concern = kwargs.pop('write_concern', None)
+        instances = list(instances)
+        bsons = [instance.to_bson() or {} for instance in instances]
+        collection = cls.get_collection()
+        ids = [bson['_id'] for bson in bsons if bson.get('_id') is not None]
+        old_bson_by_id = dict(
+            (old_bson['_id'], dict(old_bson))
+            for old_bson in collection.find({'_id': {'$in': ids}}, as_class = collections.OrderedDict)
+            ) if ids else {}
+        bulk = collection.initialize_unordered_bulk_op()
+        changes = []
+        upserts = []
+        for instance, bson in itertools.izip(instances, bsons):
+            id = bson.get('_id')
+            old_bson = old_bson_by_id.get(id) if id is not None else None
+            if old_bson is not None:
+                instance.before_compare(ctx, old_bson, bson)
+                if bson == old_bson:
+                    changes.append(False)
+                    continue
+            instance.before_upsert(ctx, old_bson, bson, *args, **kwargs)
+            if id is None:
+                instance._id = bson['_id'] = objectid.ObjectId()
+                bulk.insert(bson)
+            else:
+                bulk.find(dict(_id = id)).upsert().replace_one(bson)
+            changes.append(True)
+            upserts.append((instance, old_bson, bson))
+        bulk_write_error_info = None
+        if upserts:
+            try:
+                bulk.execute(write_concern)
+            except pymongo.errors.BulkWriteError as error:
+                # Call the hooks of the documents that have been written, then re-raise the error.
+                bulk_write_error_info = sys.exc_info()
+                failed_indexes = set(
+                    write_error['index']
+                    for write_error in error.details.get('writeErrors', [])
+                    )
+                upserts = [
+                    upsert
+                    for index, upsert in enumerate(upserts)
+                    if index not in failed_indexes
+                    ]
+        for instance, old_bson, bson in upserts:
+            if isinstance(instance, Initable):
+                instance.clear_changes()
+            instance.after_upsert(ctx, old_bson, bson, *args, **kwargs)
+        if bulk_write_error_info is not None:
+            raise bulk_write_error_info[0], bulk_write_error_info[1], bulk_write_error_info[2]
+        return changes
+
 
 # Level-3 Classes
 
 
 class ActivityStreamWrapper(SmartWrapper):
+    __slots__ = ()
     published = None
     updated = None
     words = None
@@ -347,6 +1080,10 @@ class ActivityStreamWrapper(SmartWrapper):
         bson['published'] = old_bson['published']
         bson['updated'] = old_bson['updated']
 
+    @classmethod
+    def get_versioning_attributes_name(cls):
+        return super(ActivityStreamWrapper, cls).get_versioning_attributes_name() + ('published', 'updated')
+
     def before_upsert(self, ctx, old_bson, bson, *args, **kwargs):
         super(ActivityStreamWrapper, self).before_upsert(ctx, old_bson, bson, *args, **kwargs)
         self.updated = bson['updated'] = updated = datetime.datetime.utcnow()
@@ -357,6 +1094,26 @@ class ActivityStreamWrapper(SmartWrapper):
 # Functions
 
 
+def has_default_turn_to_json(cls):
+    """Return whether a JsonMonoClassMapper class uses the default turn_to_json() & turn_to_json_attributes()."""
+    return cls.turn_to_json.im_func is JsonMonoClassMapper.turn_to_json.im_func and \
+        cls.turn_to_json_attributes.im_func is JsonMonoClassMapper.turn_to_json_attributes.im_func
+
+
+def has_instance_attribute(instance, name):
+    """Return whether attribute is set in instance (either in its __dict__ or in its slots)."""
+    try:
+        instance_dict = object.__getattribute__(instance, '__dict__')
+    except AttributeError:
+        # Slotted instance: Getting an unset slot raises an AttributeError.
+        try:
+            object.__getattribute__(instance, name)
+        except AttributeError:
+            return False
+        return True
+    return name in instance_dict
+
+
 def init_module(components):
     global contexts
     contexts = components['contexts']
@@ -364,3 +1121,69 @@ def init_module(components):
     conv = components['conv']
     Wrapper.db = components['db']
 
+
+def is_instance_method(cls, name):
+    """Return whether the method of a class with given name is defined as an instance method."""
+    for klass in cls.__mro__:
+        value = klass.__dict__.get(name)
+        if value is not None:
+            return not isinstance(value, (classmethod, staticmethod))
+    return False
+
+
+def make_attributes_serializer(cls, native = False):
+    """Generate the converter used by turn_to_json_attributes() (or to_native()) for instances of given class.
+
+    The converter is specialized for the JSON types returned by cls.get_attributes_json_type(). When native is true,
+    datetimes & ObjectIds are not converted.
+    """
+    attributes_json_type = cls.get_attributes_json_type()
+    slotted = issubclass(cls, SlottedMapper)
+    if attributes_json_type is None:
+        if not slotted:
+            return conv.object_to_clean_dict
+        attributes_json_type = {}
+    names_by_type = {}
+    for name, json_type in attributes_json_type.iteritems():
+        names_by_type.setdefault(json_type, []).append(name)
+    unknown_types = set(names_by_type).difference(['datetime', 'hidden', 'id', 'object_id'])
+    assert not unknown_types, 'Unknown JSON types for class {}: {}'.format(cls.__name__, sorted(unknown_types))
+    datetime_names = () if native else tuple(names_by_type.get('datetime', ()))
+    hidden_names = frozenset(names_by_type.get('hidden', ()))
+    id_names = tuple(names_by_type.get('id', ()))
+    object_id_names = () if native else tuple(names_by_type.get('object_id', ()))
+    id_to_json = (lambda value: value) if native else unicode
+
+    if slotted:
+        fields_default = cls._fields_default
+
+        def iter_clean_items(self):
+            for name, value in self.iter_set_attributes():
+                if value is not fields_default[name] and name not in hidden_names:
+                    yield name, value
+    else:
+        def iter_clean_items(self):
+            for name, value in self.__dict__.iteritems():
+                if getattr(cls, name, UnboundLocalError) is not value and name not in hidden_names:
+                    yield name, value
+
+    def serialize_attributes(self, state = None):
+        if self is None:
+            return self, None
+        value = dict(iter_clean_items(self))
+        for name in datetime_names:
+            attribute = value.get(name)
+            if attribute is not None:
+                value[name] = conv.datetime_to_milliseconds(attribute)
+        for name in object_id_names:
+            attribute = value.get(name)
+            if attribute is not None:
+                value[name] = unicode(attribute)
+        for name in id_names:
+            attribute = value.pop(name, None)
+            if attribute is not None:
+                value['id'] = id_to_json(attribute)
+        return value, None
+
+    return serialize_attributes
+
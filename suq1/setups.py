@@ -52,7 +52,8 @@ class Status(objects.Mapper, objects.Wrapper):
 
 
 def configure(ctx):
-    urls.application_url = ctx.req.application_url
+    if ctx.req.application_url != urls.application_url:
+        urls.set_application_url(ctx.req.application_url)
 
 
 def init(components):
@@ -28,11 +28,12 @@
 
 
 import re
+import sre_constants
+import sre_parse
 import urllib
 import urlparse
 
 from biryani1 import strings
-import webob
 
 from . import wsgihelpers
 
@@ -43,55 +44,87 @@ __all__ = [
     'get_url',
     # 'iter_full_urls',
     'make_router',
+    'quote_path',
     'relative_query',
+    'set_application_url',
+    'UrlTemplate',
     ]
 
 application_url = None  # Set to req.application_url as soon as application is called.
+base_path = u''  # Cache of the path of application_url (without trailing slash), refreshed by set_application_url()
+base_url = u''  # Cache of application_url without trailing slash, refreshed by set_application_url()
+base_url_application_url = None  # Value of application_url when base_url & base_path were computed
 conf = None  # from ??? import conf
 contexts = None  # from ??? import contexts
+quoted_fragments = {}  # Cache of quote_fragment(), cleared when full
+quoted_fragments_max_size = 4096
+
+
+class UrlTemplate(object):
+    """Template of URL path, whose static fragments are quoted once
+
+    Path variables are written between braces, eg ``UrlTemplate(u'accounts/{id}/edit')``. When generating an URL,
+    only the variables are quoted; the other keyword arguments are used as query.
+    """
+    fragments = None  # List of couples (name of variable or None, quoted static fragment or None)
+
+    def __init__(self, path):
+        self.fragments = [
+            (fragment[1:-1], None)
+            if fragment.startswith(u'{') and fragment.endswith(u'}')
+            else (None, quote_fragment(fragment))
+            for fragment in unicode(path).split(u'/')
+            if fragment
+            ]
+
+    def get_full_url(self, ctx, **query):
+        return self.make_url(get_base_url(ctx, full = True), query)
+
+    def get_url(self, ctx, **query):
+        return self.make_url(get_base_url(ctx), query)
+
+    def make_url(self, base, query):
+        path = []
+        for name, quoted_fragment in self.fragments:
+            if name is not None:
+                quoted_fragment = quote_path((query.pop(name, None),))
+                if not quoted_fragment:
+                    continue
+            path.append(quoted_fragment)
+        return u'{0}/{1}{2}'.format(base, u'/'.join(path), make_query_string(query))
 
 
 def get_base_url(ctx, full = False):
     assert not(application_url is None and full), "Can't use full URLs when application_url is not inited."
-    base_url = (application_url or u'').rstrip('/')
-    if not full:
-        # When a full URL is not requested, remove scheme and network location from it.
-        base_url = urlparse.urlsplit(base_url).path
-    return base_url
+    if application_url is not base_url_application_url:
+        # application_url has been modified without calling set_application_url().
+        set_application_url(application_url)
+    # When a full URL is not requested, remove scheme and network location from it.
+    return base_url if full else base_path
 
 
 def get_full_url(ctx, *path, **query):
-    path = [
-        urllib.quote(unicode(sub_fragment).encode('utf-8'), safe = ',/:').decode('utf-8')
-        for fragment in path
-        if fragment
-        for sub_fragment in unicode(fragment).split(u'/')
-        if sub_fragment
-        ]
-    query = dict(
-        (str(name), strings.deep_encode(value))
-        for name, value in sorted(query.iteritems())
-        if value not in (None, [], (), '')
-        )
-    return u'{0}/{1}{2}'.format(get_base_url(ctx, full = True), u'/'.join(path),
-        ('?' + urllib.urlencode(query, doseq = True)) if query else '')
+    return u'{0}/{1}{2}'.format(get_base_url(ctx, full = True), quote_path(path), make_query_string(query))
 
 
 def get_url(ctx, *path, **query):
-    path = [
-        urllib.quote(unicode(sub_fragment).encode('utf-8'), safe = ',/:').decode('utf-8')
-        for fragment in path
-        if fragment
-        for sub_fragment in unicode(fragment).split(u'/')
-        if sub_fragment
-        ]
-    query = dict(
-        (str(name), strings.deep_encode(value))
-        for name, value in sorted(query.iteritems())
-        if value not in (None, [], (), '')
-        )
-    return u'{0}/{1}{2}'.format(get_base_url(ctx), u'/'.join(path),
-        ('?' + urllib.urlencode(query, doseq = True)) if query else '')
+    return u'{0}/{1}{2}'.format(get_base_url(ctx), quote_path(path), make_query_string(query))
+
+
+def get_literal_prefix(regex):
+    """Return the codes of the characters that start every string matched by a compiled regular expression."""
+    if regex.flags & re.IGNORECASE:
+        return []
+    prefix = []
+    for opcode, argument in sre_parse.parse(regex.pattern, regex.flags):
+        if opcode == sre_constants.LITERAL:
+            prefix.append(argument)
+        elif opcode == sre_constants.AT and argument in (sre_constants.AT_BEGINNING,
+                sre_constants.AT_BEGINNING_STRING):
+            continue
+        else:
+            break
+    return prefix
 
 
 def init_module(components):
@@ -124,24 +157,60 @@ def init_module(components):
 #                    ('?' + urllib.urlencode(query, doseq = True)) if query else '')
 
 
+def make_query_string(query):
+    """Return the query string (with its leading "?") of an URL, or an empty string when query is empty."""
+    query = dict(
+        (str(name), strings.deep_encode(value))
+        for name, value in sorted(query.iteritems())
+        if value not in (None, [], (), '')
+        )
+    return ('?' + urllib.urlencode(query, doseq = True)) if query else ''
+
+
 def make_router(*routings):
-    """Return a WSGI application that dispatches requests to controllers """
+    """Return a WSGI application that dispatches requests to controllers
+
+    Routes are indexed by method and by the literal prefix of their regular expression, so that only the routes whose
+    prefix starts the path are tried (in the order of routings).
+    """
     routes = []
-    for routing in routings:
+    for index, routing in enumerate(routings):
         methods, regex, app = routing[:3]
         if isinstance(methods, basestring):
             methods = (methods,)
         vars = routing[3] if len(routing) >= 4 else {}
-        routes.append((methods, re.compile(unicode(regex)), app, vars))
+        regex = re.compile(unicode(regex))
+        routes.append((index, methods, regex, app, vars, get_literal_prefix(regex)))
+    # Build a trie for each method used by the routes, and a default trie (for the routes without methods) used by
+    # the other methods.
+    methods_name = set(
+        method
+        for route in routes
+        if route[1] is not None
+        for method in route[1]
+        )
+    default_trie = make_routes_trie(
+        route
+        for route in routes
+        if route[1] is None
+        )
+    trie_by_method = dict(
+        (method, make_routes_trie(
+            route
+            for route in routes
+            if route[1] is None or method in route[1]
+            ))
+        for method in methods_name
+        )
 
     def router(environ, start_response):
         """Dispatch request to controllers."""
-        req = webob.Request(environ)
+        req = wsgihelpers.get_request(environ)
         split_path_info = req.path_info.split('/')
         if split_path_info[0]:
             # When path_info doesn't start with a "/" this is an error or a attack => Reject request.
             # An example of an URL with such a invalid path_info: http://127.0.0.1http%3A//127.0.0.1%3A80/result?...
-            ctx = contexts.Ctx(req)
+            ctx = contexts.Ctx.from_req(req)
             headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
             return wsgihelpers.respond_json(ctx,
                 dict(
@@ -153,18 +222,27 @@ def make_router(*routings):
                     ),
                 headers = headers,
                 )(environ, start_response)
-        for methods, regex, app, vars in routes:
-            if methods is None or req.method in methods:
-                match = regex.match(req.path_info)
-                if match is not None:
-                    if getattr(req, 'urlvars', None) is None:
-                        req.urlvars = {}
-                    req.urlvars.update(match.groupdict())
-                    req.urlvars.update(vars)
-                    req.script_name += req.path_info[:match.end()]
-                    req.path_info = req.path_info[match.end():]
-                    return app(req.environ, start_response)
-        ctx = contexts.Ctx(req)
+        path_info = req.path_info
+        # Walk the trie along the path, to collect the routes whose literal prefix starts the path.
+        node = trie_by_method.get(req.method, default_trie)
+        candidates = list(node[1])
+        for char_code in bytearray(path_info) if isinstance(path_info, str) else (ord(char) for char in path_info):
+            node = node[0].get(char_code)
+            if node is None:
+                break
+            candidates.extend(node[1])
+        candidates.sort()
+        for index, regex, app, vars in candidates:
+            match = regex.match(path_info)
+            if match is not None:
+                if getattr(req, 'urlvars', None) is None:
+                    req.urlvars = {}
+                req.urlvars.update(match.groupdict())
+                req.urlvars.update(vars)
+                req.script_name += path_info[:match.end()]
+                req.path_info = path_info[match.end():]
+                return app(req.environ, start_response)
+        ctx = contexts.Ctx.from_req(req)
         headers = wsgihelpers.handle_cross_origin_resource_sharing(ctx)
         return wsgihelpers.respond_json(ctx,
             dict(
@@ -180,7 +258,58 @@ def make_router(*routings):
     return router
 
 
+def make_routes_trie(routes):
+    """Return a trie of routes, indexed by the literal prefix of their regular expression.
+
+    Each node of the trie is a couple (children nodes by character code, routes whose prefix ends at node).
+    """
+    trie = ({}, [])
+    for index, methods, regex, app, vars, prefix in routes:
+        node = trie
+        for char_code in prefix:
+            node = node[0].setdefault(char_code, ({}, []))
+        node[1].append((index, regex, app, vars))
+    return trie
+
+
+def quote_fragment(fragment):
+    """Return the quoted form of a path fragment (not containing "/"), using a bounded cache.
+
+    The cache is a plain dict, cleared when it is full: Its operations are atomic, so it needs no lock.
+    """
+    quoted_fragment = quoted_fragments.get(fragment)
+    if quoted_fragment is None:
+        quoted_fragment = urllib.quote(fragment.encode('utf-8'), safe = ',/:').decode('utf-8')
+        if len(quoted_fragments) >= quoted_fragments_max_size:
+            quoted_fragments.clear()
+        quoted_fragments[fragment] = quoted_fragment
+    return quoted_fragment
+
+
+def quote_path(path):
+    """Return the quoted path made of the given fragments, ignoring empty fragments."""
+    return u'/'.join(
+        quote_fragment(sub_fragment)
+        for fragment in path
+        if fragment
+        for sub_fragment in unicode(fragment).split(u'/')
+        if sub_fragment
+        )
+
+
 def relative_query(inputs, **query):
     inputs = inputs.copy()
     inputs.update(query)
     return inputs
+
+
+def set_application_url(url):
+    """Set application_url and refresh the base URL & path derived from it."""
+    global application_url
+    application_url = url
+    global base_path
+    global base_url
+    base_url = (url or u'').rstrip('/')
+    base_path = urlparse.urlsplit(base_url).path
+    global base_url_application_url
+    base_url_application_url = url
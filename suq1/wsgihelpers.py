@@ -27,10 +27,14 @@
 """Decorators and functions to simplify use of webob for WSGI applications.
 
 The main decorator :class:`wsgify` turns a function into a WSGI application.
+
+A single webob.Request is created per WSGI call: every layer (middlewares, router, controllers) gets it using
+:func:`get_request`.
 """
 
 
 import collections
+import hashlib
 import json
 
 import webob.dec
@@ -38,15 +42,45 @@ import webob.exc
 
 
 __all__ = [
+    'Envelope',
+    'encode_json',
+    'encode_msgpack',
     'errors_title',
+    'get_instance_validators',
+    'get_request',
     'handle_cross_origin_resource_sharing',
     'init_module',
+    'make_envelope',
+    'make_error',
+    'prefers_msgpack',
+    'read_body_inputs',
+    'Request',
+    'respond_data',
     'respond_json',
+    'respond_json_cursor',
+    'respond_not_modified',
     'wsgify',
     ]
 
 N_ = lambda message: message
 
+conv = None  # from ??? import conv
+
+# JSON encoders are built once and reused. ASCII encoders are used when data mixes unicode & non ASCII str.
+# Their default function calls conv.json_default(), because conv is set by init_module().
+ascii_json_encoder = json.JSONEncoder(default = lambda value: conv.json_default(value), ensure_ascii = True,
+    separators = (',', ':'))
+indented_ascii_json_encoder = json.JSONEncoder(default = lambda value: conv.json_default(value),
+    ensure_ascii = True, indent = 2, separators = (',', ': '))
+indented_json_encoder = json.JSONEncoder(default = lambda value: conv.json_default(value), encoding = 'utf-8',
+    ensure_ascii = False, indent = 2, separators = (',', ': '))
+json_encoder = json.JSONEncoder(default = lambda value: conv.json_default(value), encoding = 'utf-8',
+    ensure_ascii = False, separators = (',', ':'))
+max_body_size = 1024 * 1024  # Maximum size (in bytes) of the body of a JSON (or MessagePack) request
+max_hashed_body_size = 64 * 1024  # Maximum size (in bytes) of a response body hashed to compute a missing ETag
+msgpack_content_types = ('application/msgpack', 'application/x-msgpack')
+pretty_json = False  # When true, JSON responses are indented (for debugging)
+
 errors_title = {
     400: N_("Unable to Access"),
     401: N_("Access Denied"),
@@ -54,7 +88,69 @@ errors_title = {
     404: N_("Unable to Access"),
     }
 
-wsgify = webob.dec.wsgify
+
+class Envelope(collections.OrderedDict):
+    """Response envelope (or error) built without null properties, that respond_json doesn't need to clean up"""
+
+
+class Request(webob.Request):
+    """Request created only once per WSGI environment: Instantiating it again with the same environment returns the
+    request stored in it.
+    """
+    def __init__(self, environ, *args, **kwargs):
+        if 'environ' not in self.__dict__:
+            super(Request, self).__init__(environ, *args, **kwargs)
+
+    def __new__(cls, environ, *args, **kwargs):
+        req = environ.get('suq1.request')
+        # When a middleware has copied the environment, the stored request belongs to the original one.
+        if not isinstance(req, cls) or req.environ is not environ:
+            req = environ['suq1.request'] = super(Request, cls).__new__(cls)
+        return req
+
+
+class wsgify(webob.dec.wsgify):
+    """Decorator that turns a function into a WSGI application, reusing the request of the WSGI call"""
+    RequestClass = Request
+
+
+def encode_json(data, pretty = None):
+    """Encode data to a UTF-8 JSON string, compact unless pretty (or module setting pretty_json) is true."""
+    if pretty is None:
+        pretty = pretty_json
+    try:
+        text = (indented_json_encoder if pretty else json_encoder).encode(data)
+    except UnicodeDecodeError:
+        text = (indented_ascii_json_encoder if pretty else ascii_json_encoder).encode(data)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return text
+
+
+def encode_msgpack(data):
+    """Encode data to a MessagePack string, with ObjectIds & datetimes encoded as extension types."""
+    return conv.msgpack.packb(data, default = conv.msgpack_default, use_bin_type = False)
+
+
+def get_instance_validators(instance):
+    """Return the ETag & the Last-Modified date of an instance, derived from its draft_id & updated attributes.
+
+    Each real change of a SmartWrapper instance gives it a new draft_id, so draft_id is used as ETag.
+    """
+    draft_id = getattr(instance, 'draft_id', None)
+    updated = getattr(instance, 'updated', None)
+    if draft_id is not None:
+        etag = str(draft_id)
+    elif updated is not None:
+        etag = updated.isoformat()
+    else:
+        etag = None
+    return etag, updated
+
+
+def get_request(environ):
+    """Return the request of a WSGI environment, created only once per WSGI call and stored in environment."""
+    return Request(environ)
 
 
 def handle_cross_origin_resource_sharing(ctx):
@@ -81,14 +177,199 @@ def handle_cross_origin_resource_sharing(ctx):
     return headers
 
 
-def respond_json(ctx, data, code = None, headers = None, jsonp = None):
+def make_envelope(ctx, api_version = '1.0', context = None, error = None, params = None, **items):
+    """Return the envelope of a response, with its properties in a fixed order and without null properties.
+
+    The order is: apiVersion, the other items (sorted by name), context, error, method, params & url.
+    """
+    req = ctx.req
+    envelope = Envelope()
+    envelope['apiVersion'] = api_version
+    for name in sorted(items):
+        value = items[name]
+        if value is not None:
+            envelope[name] = value
+    if context is not None:
+        envelope['context'] = context
+    if error is not None:
+        envelope['error'] = error
+    envelope['method'] = req.script_name
+    if params is not None:
+        envelope['params'] = params
+    envelope['url'] = req.url.decode('utf-8')
+    return envelope
+
+
+def make_error(code = None, errors = None, message = None):
+    """Return the error of a response envelope, with its properties in a fixed order and without null properties."""
+    error = Envelope()
+    if code is not None:
+        error['code'] = code
+    if errors is not None:
+        error['errors'] = errors
+    if message is not None:
+        error['message'] = message
+    return error
+
+
+def prefers_msgpack(req):
+    """Return whether the Accept header of request prefers MessagePack to JSON (and MessagePack is available)."""
+    accept = req.environ.get('HTTP_ACCEPT')
+    if not accept or conv.msgpack is None or 'msgpack' not in accept:
+        return False
+    qualities = {}
+    for item in accept.split(','):
+        media_type, _, parameters = item.partition(';')
+        quality = 1.0
+        for parameter in parameters.split(';'):
+            parameter_name, _, parameter_value = parameter.partition('=')
+            if parameter_name.strip().lower() == 'q':
+                try:
+                    quality = float(parameter_value)
+                except ValueError:
+                    quality = 0.0
+        qualities[media_type.strip().lower()] = quality
+    msgpack_quality = max(qualities.get('application/msgpack', 0.0), qualities.get('application/x-msgpack', 0.0))
+    json_quality = qualities.get('application/json', qualities.get('application/*', qualities.get('*/*', 0.0)))
+    return msgpack_quality > 0.0 and msgpack_quality >= json_quality
+
+
+def read_body_inputs(ctx, headers = None, required = True):
+    """Check, read & decode the JSON (or MessagePack) body of a request, without reading more than max_body_size bytes.
+
+    Return a couple (inputs, response), where inputs is the decoded dictionary and response is None, or inputs is None
+    and response is the error response to return.
+    """
+    req = ctx.req
+    content_type = req.content_type
+    if content_type is not None:
+        content_type = content_type.split(';', 1)[0].strip()
+    if content_type == 'application/json':
+        input_to_inputs = conv.make_input_to_json(object_pairs_hook = collections.OrderedDict)
+    elif content_type in msgpack_content_types and conv.msgpack is not None:
+        input_to_inputs = conv.make_input_to_msgpack(object_pairs_hook = collections.OrderedDict)
+    else:
+        return None, respond_data(ctx,
+            make_envelope(ctx,
+                error = make_error(
+                    code = 400,  # Bad Request
+                    message = ctx._(u'Bad content-type: {}').format(content_type),
+                    ),
+                ),
+            headers = headers,
+            )
+
+    # Reject a too large body before reading it, when its size is known, or while reading it.
+    content_length = req.content_length
+    if content_length is None:
+        # Without Content-Length, only read a chunked body that the server terminates, otherwise reading could block.
+        if 'chunked' not in req.environ.get('HTTP_TRANSFER_ENCODING', '').lower() or not req.is_body_readable:
+            return None, respond_data(ctx,
+                make_envelope(ctx,
+                    error = make_error(
+                        code = 411,  # Length Required
+                        message = ctx._(u'Request has no Content-Length header'),
+                        ),
+                    ),
+                headers = headers,
+                )
+        body = req.body_file.read(max_body_size + 1)
+        too_large = len(body) > max_body_size
+        if not too_large:
+            req.body = body
+    else:
+        too_large = content_length > max_body_size
+        if not too_large:
+            body = req.body
+    if too_large:
+        return None, respond_data(ctx,
+            make_envelope(ctx,
+                error = make_error(
+                    code = 413,  # Request Entity Too Large
+                    message = ctx._(u'Request body exceeds the maximum size of {} bytes').format(max_body_size),
+                    ),
+                ),
+            headers = headers,
+            )
+
+    inputs, error = conv.pipe(
+        input_to_inputs,
+        conv.test_isinstance(dict),
+        conv.not_none if required else conv.noop,
+        )(body, state = ctx)
+    if error is not None:
+        if content_type == 'application/json':
+            message = ctx._(u'Invalid JSON in request POST body')
+        else:
+            message = ctx._(u'Invalid MessagePack in request POST body')
+        return None, respond_data(ctx,
+            make_envelope(ctx,
+                error = make_error(
+                    code = 400,  # Bad Request
+                    errors = [error],
+                    message = message,
+                    ),
+                params = body if content_type == 'application/json' else None,
+                ),
+            headers = headers,
+            )
+    return inputs, None
+
+
+def respond_data(ctx, data, code = None, etag = None, headers = None, jsonp = None, last_modified = None,
+        make_native_data = None, pretty = None):
+    """Return a MessagePack response when client prefers it, otherwise a JSON response.
+
+    The format is negotiated using the Accept header of the request. JSONP responses are always JSON.
+
+    make_native_data is an optional function returning the data of MessagePack responses, with native ObjectIds &
+    datetimes (like the result of to_native() instead of to_json()). It is called only when MessagePack is negotiated.
+    """
+    headers = list(headers or [])
+    headers.append(('Vary', 'Accept'))
+    use_msgpack = not jsonp and prefers_msgpack(ctx.req)
+    if use_msgpack and make_native_data is not None:
+        data = make_native_data()
+    return respond_json(ctx, data, code = code, etag = etag, headers = headers, jsonp = jsonp,
+        last_modified = last_modified, pretty = pretty, use_msgpack = use_msgpack)
+
+
+def respond_json(ctx, data, code = None, etag = None, headers = None, jsonp = None, last_modified = None,
+        pretty = None, use_msgpack = False):
     """Return a JSON response.
 
     This function is optimized for JSON following
     `Google JSON Style Guide <http://google-styleguide.googlecode.com/svn/trunk/jsoncstyleguide.xml>`_, but will handle
     any JSON except for HTTP errors.
+
+    The JSON is compact, unless pretty (or module setting pretty_json) is true. When use_msgpack is true, data is
+    encoded to MessagePack instead.
+
+    For successful GET & HEAD requests, the response has an ETag (computed from the body when not given and the body is
+    not larger than max_hashed_body_size) and a "304 Not Modified" response is returned when the request is conditional
+    and matches. The ETag of MessagePack & JSONP responses ends with their format, so that they differ from JSON ones.
     """
-    if isinstance(data, collections.Mapping):
+    if use_msgpack:
+        content_type = 'application/x-msgpack'
+        etag_suffix = '-msgpack'
+    elif jsonp:
+        content_type = 'application/javascript; charset=utf-8'
+        etag_suffix = '-jsonp'
+    else:
+        content_type = 'application/json; charset=utf-8'
+        etag_suffix = ''
+    if etag is not None:
+        etag += etag_suffix
+    conditional = code in (None, 200) and ctx.req.method in ('GET', 'HEAD')
+    if conditional and (etag is not None or last_modified is not None):
+        # Don't serialize data when client already has it.
+        response = respond_not_modified(ctx, etag = etag, headers = headers, last_modified = last_modified)
+        if response is not None:
+            return response
+    if isinstance(data, Envelope):
+        # Envelope has no null properties.
+        error = data.get('error')
+    elif isinstance(data, collections.Mapping):
         # Remove null properties as recommended by Google JSON Style Guide.
         data = type(data)(
             (name, value)
@@ -96,7 +377,7 @@ def respond_json(ctx, data, code = None, headers = None, jsonp = None):
             if value is not None
             )
         error = data.get('error')
-        if isinstance(error, collections.Mapping):
+        if isinstance(error, collections.Mapping) and not isinstance(error, Envelope):
             error = data['error'] = type(error)(
                 (name, value)
                 for name, value in error.iteritems()
@@ -106,10 +387,6 @@ def respond_json(ctx, data, code = None, headers = None, jsonp = None):
         error = None
     if headers is None:
         headers = []
-    if jsonp:
-        content_type = 'application/javascript; charset=utf-8'
-    else:
-        content_type = 'application/json; charset=utf-8'
     if error:
         code = code or error['code']
         assert isinstance(code, int)
@@ -129,17 +406,103 @@ def respond_json(ctx, data, code = None, headers = None, jsonp = None):
         if code is not None:
             response.status = code
         response.headers.update(headers)
-    try:
-        text = json.dumps(data, encoding = 'utf-8', ensure_ascii = False, indent = 2)
-    except UnicodeDecodeError:
-        text = json.dumps(data, ensure_ascii = True, indent = 2)
-    text = unicode(text)
+    body = encode_msgpack(data) if use_msgpack else encode_json(data, pretty = pretty)
     if jsonp:
-        text = u'{0}({1})'.format(jsonp, text)
-    response.text = text
+        body = '{0}({1})'.format(jsonp.encode('utf-8') if isinstance(jsonp, unicode) else jsonp, body)
+    if conditional and not error:
+        if etag is None and len(body) <= max_hashed_body_size:
+            etag = hashlib.md5(body).hexdigest() + etag_suffix
+            not_modified_response = respond_not_modified(ctx, etag = etag, headers = headers)
+            if not_modified_response is not None:
+                return not_modified_response
+        if etag is not None:
+            response.etag = etag
+        if last_modified is not None:
+            response.last_modified = last_modified
+    response.body = body
+    return response
+
+
+def respond_json_cursor(ctx, data, cursor, code = None, headers = None, pretty = None, state = None):
+    """Return a JSON response whose ``data.items`` are streamed from a cursor (or any iterable of mapper instances).
+
+    data is the envelope of the response (apiVersion, method, url...). Its ``data`` property, when present, must be a
+    mapping and is completed with ``items``.
+
+    Each instance is converted using its to_json() method and encoded only when the WSGI server iterates over the
+    response, so memory stays flat regardless of the number of instances.
+    """
+    if state is None:
+        state = ctx
+    # Encode the envelope with a marker in place of the items, then split it around the marker.
+    items_marker = u'\x00items\x00'
+    # Copy the envelope, because its data property is replaced below.
+    data = type(data)(
+        (name, value)
+        for name, value in data.iteritems()
+        if value is not None
+        )
+    data_data = data.get('data')
+    data_data = collections.OrderedDict() if data_data is None else type(data_data)(
+        (name, value)
+        for name, value in data_data.iteritems()
+        if value is not None
+        )
+    data_data['items'] = items_marker
+    data['data'] = data_data
+    head, tail = encode_json(data, pretty = pretty).split(encode_json(items_marker), 1)
+
+    def iter_body():
+        yield head + '['
+        separator = ''
+        for instance in cursor:
+            yield separator + encode_json(instance.to_json(state = state), pretty = pretty)
+            separator = ','
+        yield ']' + tail
+
+    response = ctx.req.response
+    response.content_type = 'application/json; charset=utf-8'
+    if code is not None:
+        response.status = code
+    if headers:
+        response.headers.update(headers)
+    response.app_iter = iter_body()
+    response.content_length = None
+    return response
+
+
+def respond_not_modified(ctx, etag = None, headers = None, last_modified = None):
+    """Return a "304 Not Modified" response when a GET or HEAD request is conditional and matches, otherwise None.
+
+    If-None-Match is checked against etag; If-Modified-Since is checked against last_modified (a naive UTC datetime)
+    only when request has no If-None-Match header.
+    """
+    req = ctx.req
+    if req.method not in ('GET', 'HEAD'):
+        return None
+    if req.environ.get('HTTP_IF_NONE_MATCH'):
+        if etag is None or etag not in req.if_none_match:
+            return None
+    elif last_modified is not None and req.if_modified_since is not None:
+        if last_modified.replace(microsecond = 0, tzinfo = None) > req.if_modified_since.replace(tzinfo = None):
+            return None
+    else:
+        return None
+    response = webob.exc.status_map[304](headers = headers)  # Not Modified
+    if etag is not None:
+        response.etag = etag
+    if last_modified is not None:
+        response.last_modified = last_modified
     return response
 
 
 def init_module(components):
-    pass
+    global conv
+    conv = components['conv']
+    global max_body_size
+    max_body_size = components['conf'].get('max_body_size') or max_body_size
+    global max_hashed_body_size
+    max_hashed_body_size = components['conf'].get('max_hashed_body_size', max_hashed_body_size)
+    global pretty_json
+    pretty_json = bool(components['conf'].get('pretty_json'))
 